@@ -0,0 +1,81 @@
+# 料理抽選のベンチマーク: FoodSampler と ORDER BY RANDOM() を比べる
+# 使い方: python benchmarks/bench_sampler.py
+# DATABASE_URL があればSQL側も計測する（一時テーブルを使うので本番データは触らない）
+import os
+import sys
+import time
+import random
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from food_sampler import FoodSampler
+
+SIZES = (10_000, 100_000, 1_000_000)
+PICKS = int(os.environ.get("BENCH_PICKS", "1000"))
+SQL_PICKS = int(os.environ.get("BENCH_SQL_PICKS", "50"))
+GENRES = [str(i) for i in range(1, 9)]
+STYLES = ["1", "2"]
+TYPES = ["1", "2", "3"]
+
+
+def make_rows(n):
+    rnd = random.Random(n)
+    return [
+        (f"料理{i}", rnd.choice(TYPES), rnd.choice(GENRES), rnd.choice(STYLES))
+        for i in range(n)
+    ]
+
+
+def bench_memory(rows):
+    sampler = FoodSampler()
+    start = time.perf_counter()
+    sampler.rebuild(rows)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(PICKS):
+        sampler.pick_by_type("1")
+        sampler.pick_by_genre_style("1", "1")
+    pick = (time.perf_counter() - start) / (PICKS * 2)
+    return build, pick
+
+
+async def bench_sql(rows):
+    import asyncpg
+
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    try:
+        await conn.execute("""
+            CREATE TEMP TABLE foods (name text, type text, genre text, style text)
+        """)
+        await conn.copy_records_to_table("foods", records=rows)
+        await conn.execute("ANALYZE foods")
+        by_type = await conn.prepare("""
+            SELECT name FROM foods WHERE type = $1 OR type = '3' ORDER BY RANDOM() LIMIT 1
+        """)
+        by_genre_style = await conn.prepare("""
+            SELECT name FROM foods WHERE genre = $1 AND style = $2 ORDER BY RANDOM() LIMIT 1
+        """)
+        start = time.perf_counter()
+        for _ in range(SQL_PICKS):
+            await by_type.fetchval("1")
+            await by_genre_style.fetchval("1", "1")
+        return (time.perf_counter() - start) / (SQL_PICKS * 2)
+    finally:
+        await conn.close()
+
+
+def main():
+    use_sql = bool(os.environ.get("DATABASE_URL"))
+    print(f"{'rows':>10} {'build(ms)':>10} {'memory(us)':>11} {'sql(us)':>10}")
+    for n in SIZES:
+        rows = make_rows(n)
+        build, pick = bench_memory(rows)
+        sql = asyncio.run(bench_sql(rows)) if use_sql else None
+        sql_text = f"{sql * 1e6:10.1f}" if sql is not None else f"{'-':>10}"
+        print(f"{n:>10} {build * 1e3:10.1f} {pick * 1e6:11.2f} {sql_text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Geminiのストリーミング返信の確認: 最初に表示されるまでの時間・書き換え回数・同時押しのまとめ・Viewタイムアウトでの中断
+# 本物の FoodDetailButton / stream_gemini_reply を、偽のInteractionと fake_gemini のストリームで動かす
+# 使い方: python benchmarks/bench_stream.py --chunks 10 --chunk-delay 0.3
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+import gemini
+from fake_gemini import FakeGeminiModel
+from load_test import FakeChannel, FakeInteraction, FakeUser
+
+
+async def press_detail(food, channel, cancel_after=None):
+    view = bot.FoodDetailView(food)
+    interaction = FakeInteraction(FakeUser(1), channel)
+    start = time.perf_counter()
+    task = asyncio.get_running_loop().create_task(view.children[0].callback(interaction))
+    if cancel_after is not None:
+        await asyncio.sleep(cancel_after)
+        await view.on_timeout()
+    await task
+    return start, time.perf_counter()
+
+
+def show_timeline(start, end, channel):
+    sends = [t for t, kind, _ in channel.events if kind == "send"]
+    edits = [t for t, kind, _ in channel.events if kind == "edit"]
+    first = (sends[0] - start) * 1000 if sends else float("nan")
+    print(f"  最初の表示: {first:7.0f}ms  完了: {(end - start) * 1000:7.0f}ms  書き換え: {len(edits)}回")
+    if channel.events:
+        print(f"  最終表示: {channel.events[-1][2]}")
+
+
+async def main(args):
+    model = FakeGeminiModel(args.latency, args.chunk_delay, args.chunks)
+    gemini.client.model = model
+    slots = gemini.client._semaphore._value
+
+    print(f"ストリーミング（{args.chunks}チャンク × {args.chunk_delay}s、書き換え間隔 {bot.STREAM_EDIT_INTERVAL}s）")
+    channel = FakeChannel(1, args.discord_latency)
+    start, end = await press_detail("麻婆豆腐", channel)
+    show_timeline(start, end, channel)
+
+    print("2回目（キャッシュから全文を1回で表示）")
+    channel = FakeChannel(1, args.discord_latency)
+    start, end = await press_detail("麻婆豆腐", channel)
+    show_timeline(start, end, channel)
+
+    cancel_after = args.latency + args.chunk_delay * args.chunks / 3
+    print(f"同時に{args.clicks}回押す（1回目だけ{cancel_after:.1f}s後にViewタイムアウト）")
+    calls_before = model.calls
+    channels = [FakeChannel(1, args.discord_latency) for _ in range(args.clicks)]
+    results = await asyncio.gather(*(
+        press_detail("回鍋肉", channel, cancel_after=cancel_after if i == 0 else None)
+        for i, channel in enumerate(channels)
+    ))
+    for (start, end), channel in zip(results, channels):
+        show_timeline(start, end, channel)
+    print(f"  モデル呼び出し: {model.calls - calls_before}回  枠を返した: {gemini.client._semaphore._value == slots}")
+
+    print(f"Viewタイムアウトで中断（{cancel_after:.1f}s後）")
+    channel = FakeChannel(1, args.discord_latency)
+    sent_before = model.chunks_sent
+    closed_before = model.streams_closed
+    start, end = await press_detail("青椒肉絲", channel, cancel_after=cancel_after)
+    show_timeline(start, end, channel)
+    chunks = model.chunks_sent - sent_before
+    closed = model.streams_closed - closed_before
+    released = gemini.client._semaphore._value == slots
+    print(f"  受け取ったチャンク: {chunks}/{args.chunks}  ストリームを閉じた: {closed == 1}  枠を返した: {released}")
+    cached = gemini.client.cache.get(bot.food_description_prompt("青椒肉絲")) is not None
+    print(f"  途中の文をキャッシュしていない: {not cached}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Geminiストリーミング返信の確認")
+    parser.add_argument("--latency", type=float, default=0.5, help="最初のチャンクまでの時間")
+    parser.add_argument("--chunk-delay", type=float, default=0.3)
+    parser.add_argument("--chunks", type=int, default=10)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--clicks", type=int, default=5, help="同じ料理のボタンを同時に押す回数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,54 @@
+# 料理名の正規化と表記ゆれ判定の退行チェック: Geminiの返事の言い回しで重複登録されないか確かめる
+# 使い方: python benchmarks/check_dedup.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dedup
+
+# (Geminiの返事, clean_name の結果)
+CLEAN_CASES = (
+    ("麻婆豆腐", "麻婆豆腐"),
+    ("麻婆豆腐です。", "麻婆豆腐"),
+    ("麻婆豆腐がおすすめです！", "麻婆豆腐"),
+    ("麻婆豆腐がおすすめだよ！", "麻婆豆腐"),
+    ("麻婆豆腐はいかがですか？", "麻婆豆腐"),
+    ("麻婆豆腐はいかがでしょうか？", "麻婆豆腐"),
+    ("「麻婆豆腐」がおすすめですね〜", "麻婆豆腐"),
+    ("焼き魚とか？", "焼き魚"),
+    ("焼きさかな。", "焼きさかな"),
+    ("焼きさかなです！", "焼きさかな"),
+    ("ラーメン", "ラーメン"),
+)
+# (登録済みの料理名, 探す名前, 見つかってほしい料理名)。None は別の料理として扱ってほしいもの
+FIND_CASES = (
+    ("麻婆豆腐", "麻婆豆腐がおすすめです", "麻婆豆腐"),
+    ("麻婆豆腐", "麻婆豆腐はいかがですか？", "麻婆豆腐"),
+    ("麻婆豆腐", "ﾏｰﾎﾞｰ豆腐", None),
+    ("ラーメン", "ﾗｰﾒﾝ", "ラーメン"),
+    ("ラーメン", "ラメン", None),
+)
+
+
+def main():
+    failures = 0
+    for text, expected in CLEAN_CASES:
+        got = dedup.clean_name(text)
+        ok = got == expected
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} clean_name({text!r}) = {got!r}")
+    for existing, name, expected in FIND_CASES:
+        index = dedup.DedupIndex()
+        index.add(existing, "1", "1")
+        got = index.find(name, "1", "1")
+        ok = got == expected
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} find({name!r}) with {existing!r} = {got!r}")
+
+    print(f"❌ 想定と違うものが {failures}件あります" if failures else "✅ すべて想定どおり")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# インデックスの退行チェック: db.py のクエリを EXPLAIN して、想定したインデックスを使っているか確かめる
+# 使い方: DATABASE_URL=... python benchmarks/check_indexes.py
+# 一時スキーマに schema.py のテーブルとインデックスを作ってダミーデータを入れる（本番データは触らない）
+import os
+import sys
+import json
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import schema
+
+CHECK_SCHEMA = f"foodbot_index_check_{os.getpid()}"
+FOOD_ROWS = int(os.environ.get("CHECK_FOOD_ROWS", "200000"))
+HISTORY_ROWS = int(os.environ.get("CHECK_HISTORY_ROWS", "200000"))
+RECIPE_ROWS = int(os.environ.get("CHECK_RECIPE_ROWS", "20000"))
+USERS = 5000
+GENRES = [str(i) for i in range(1, 21)]
+STYLES = ["1", "2"]
+TYPES = ["1", "2", "3"]
+
+# (名前, クエリ, 引数, 使ってほしいインデックス)。None は結果を表示するだけ
+CHECKS = (
+    ("foods by type", db.RANDOM_FOOD_BY_TYPE, ("1",), None),
+    ("foods by genre/style", db.RANDOM_FOOD_BY_GENRE_STYLE, ("1", "1"), "foods_genre_style_name_idx"),
+    ("insert foods batch", db.INSERT_FOODS_BATCH, (["料理1"], ["1"], ["1"]), "foods_genre_style_name_idx"),
+    ("delete merged foods", db.DELETE_MERGED_FOODS, (["料理1"], ["1"], ["1"]), "foods_genre_style_name_idx"),
+    ("user top foods", db.USER_TOP_FOODS, ("user1",), "consult_history_user_food_idx"),
+    ("rewrite history foods", db.REWRITE_HISTORY_FOODS,
+     (["料理1"], ["料理2"], ["1"], ["1"]), "consult_history_result_food_idx"),
+    ("recipe cache", db.SELECT_RECIPE_CACHE, (3600.0,), "recipe_cache_fetched_at_idx"),
+)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from plan_nodes(child)
+
+
+def summarize(nodes):
+    # "Index Scan using foods_genre_style_name_idx on foods" のような1行にまとめる
+    parts = []
+    for node in nodes:
+        if "Relation Name" not in node:
+            continue
+        text = node["Node Type"]
+        if "Index Name" in node:
+            text += f" using {node['Index Name']}"
+        parts.append(f"{text} on {node['Relation Name']}")
+    return ", ".join(parts)
+
+
+async def load_rows(conn):
+    rnd = random.Random(0)
+    foods = [
+        (f"料理{i}", rnd.choice(TYPES), rnd.choice(GENRES), rnd.choice(STYLES))
+        for i in range(FOOD_ROWS)
+    ]
+    await conn.copy_records_to_table(
+        "foods", records=foods, columns=["name", "type", "genre", "style"], schema_name=CHECK_SCHEMA
+    )
+    history = [
+        (f"user{rnd.randrange(USERS)}", rnd.choice(GENRES), rnd.choice(STYLES), None, None,
+         f"料理{rnd.randrange(FOOD_ROWS)}" if rnd.random() < 0.9 else None)
+        for _ in range(HISTORY_ROWS)
+    ]
+    await conn.copy_records_to_table(
+        "consult_history", records=history,
+        columns=["user_id", "genre", "style", "request_text", "result_text", "result_food"],
+        schema_name=CHECK_SCHEMA,
+    )
+    now = datetime.now(timezone.utc)
+    recipes = [
+        (f"料理{i}", None, None, now - timedelta(seconds=rnd.randrange(30 * 24 * 3600)))
+        for i in range(RECIPE_ROWS)
+    ]
+    await conn.copy_records_to_table(
+        "recipe_cache", records=recipes,
+        columns=["food_name", "recipe_title", "recipe_url", "fetched_at"], schema_name=CHECK_SCHEMA,
+    )
+    await conn.execute("ANALYZE")
+
+
+async def main():
+    import asyncpg
+
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    failures = 0
+    try:
+        await conn.execute(f"CREATE SCHEMA {CHECK_SCHEMA}")
+        await conn.execute(f"SET search_path TO {CHECK_SCHEMA}")
+        await schema.migrate(conn)
+        status = await schema.ensure_indexes(conn)
+        await load_rows(conn)
+
+        for name, query, args, expected in CHECKS:
+            explained = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            nodes = list(plan_nodes(json.loads(explained)[0]["Plan"]))
+            used = {node.get("Index Name") for node in nodes}
+            ok = expected is None or expected in used
+            failures += not ok
+            print(f"{'OK  ' if ok else 'FAIL'} {name:24} {summarize(nodes)}")
+
+        missing = [name for name, state in status.items() if state != "ok"]
+        if missing:
+            failures += len(missing)
+            print(f"FAIL インデックスが作れていません: {missing}")
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {CHECK_SCHEMA} CASCADE")
+        await conn.close()
+
+    print(f"❌ 想定と違うものが {failures}件あります" if failures else "✅ すべて想定どおり")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,52 @@
+# ローカルで使う偽のGeminiモデル。gemini.client.model = FakeGeminiModel() で差し替える
+# stream=True のときは FAKE_GEMINI_CHUNK_DELAY ごとに少しずつ返す（ストリーミング表示の確認用）
+import os
+import asyncio
+
+FAKE_GEMINI_LATENCY = float(os.environ.get("FAKE_GEMINI_LATENCY", "0.5"))
+FAKE_GEMINI_CHUNK_DELAY = float(os.environ.get("FAKE_GEMINI_CHUNK_DELAY", "0.3"))
+FAKE_GEMINI_CHUNKS = int(os.environ.get("FAKE_GEMINI_CHUNKS", "10"))
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeStreamResponse:
+    # generate_content_async(..., stream=True) の戻り値と同じく async for で回せる
+    def __init__(self, model, chunks, delay):
+        self.model = model
+        self.chunks = chunks
+        self.delay = delay
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        try:
+            for chunk in self.chunks:
+                await asyncio.sleep(self.delay)
+                self.model.chunks_sent += 1
+                yield FakeResponse(chunk)
+        finally:
+            # 途中で閉じられたかどうかをベンチマーク側で確かめられるようにする
+            self.model.streams_closed += 1
+
+
+class FakeGeminiModel:
+    def __init__(self, latency=FAKE_GEMINI_LATENCY, chunk_delay=FAKE_GEMINI_CHUNK_DELAY, n_chunks=FAKE_GEMINI_CHUNKS):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.n_chunks = n_chunks
+        self.calls = 0
+        self.chunks_sent = 0
+        self.streams_closed = 0
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if stream:
+            chunks = [f"その{i + 1}。" for i in range(self.n_chunks)]
+            return FakeStreamResponse(self, chunks, self.chunk_delay)
+        return FakeResponse(f"麻婆豆腐 ({len(prompt)}文字のプロンプトへの回答)")
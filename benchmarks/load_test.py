@@ -0,0 +1,317 @@
+# 同時にたくさんの人がガチャ・コンサルを使ったときの負荷試験
+# 本物の FoodChoiceView → GenreView → StyleView → RequestView → show_consult_result を偽のInteractionで動かす
+# 送信・編集は dispatch.py の枠を通るので、同じチャンネルに人が集まると枠待ちもレイテンシに入る
+#
+# 使い方:
+#   python benchmarks/load_test.py --users 200 --concurrency 50
+#   DATABASE_URL=... python benchmarks/load_test.py --db      # ローカルのPostgresを使う
+# --db なしのときはマスタ・料理をメモリに用意して、DB書き込みは --db-latency だけ待つ代わりのもので受ける
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+from aiohttp import web
+
+import bot
+import gemini
+import rakuten
+import stub_servers
+from fake_gemini import FakeGeminiModel
+
+DISCORD_DEADLINE = 3.0
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.missed = {}
+        self.errors = 0
+
+    def add(self, step, seconds, acked_in):
+        self.latencies.setdefault(step, []).append(seconds)
+        if acked_in is not None and acked_in > DISCORD_DEADLINE:
+            self.missed[step] = self.missed.get(step, 0) + 1
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+        self.mention = f"<@{user_id}>"
+
+
+class FakeMessage:
+    _ids = iter(range(1, 10**12))
+
+    def __init__(self, channel=None, author=None, content=""):
+        self.id = next(FakeMessage._ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+    async def edit(self, content=None, view=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        self.channel.record("edit", content)
+        if view is not None:
+            self.channel.last_view = view
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+
+class FakeChannel:
+    # ユーザーごとに送られたViewを覚えておく（同じチャンネルIDを共有してもいい）
+    def __init__(self, channel_id, latency):
+        self.id = channel_id
+        self.latency = latency
+        self.last_view = None
+        # (時刻, "send" / "edit", 内容)
+        self.events = []
+
+    def record(self, kind, content):
+        self.events.append((time.perf_counter(), kind, content))
+
+    async def send(self, content=None, view=None, delete_after=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.record("send", content)
+        if view is not None:
+            self.last_view = view
+        return FakeMessage(self, content=content)
+
+    async def delete_messages(self, messages):
+        await asyncio.sleep(self.latency)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.view = None
+
+    def _ack(self):
+        if self.interaction.acked_at is None:
+            self.interaction.acked_at = time.perf_counter()
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._ack()
+
+    async def send_message(self, content=None, view=None, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._ack()
+        if view is not None:
+            self.view = view
+
+    async def edit_message(self, content=None, view=None, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._ack()
+        if view is not None:
+            self.view = view
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, view=None, **kwargs):
+        return await self.interaction.channel.send(content, view=view)
+
+
+class FakeInteraction(discord.Interaction):
+    # discord.Interaction として扱われるように継承だけして、中身は偽物にする
+    _ids = iter(range(1, 10**12))
+
+    def __init__(self, user, channel):
+        self.id = next(FakeInteraction._ids)
+        self.user = user
+        self.message = FakeMessage(channel)
+        self._fake_channel = channel
+        self._fake_response = FakeResponse(self)
+        self._fake_followup = FakeFollowup(self)
+        self.created_at_perf = time.perf_counter()
+        self.acked_at = None
+
+    @property
+    def channel(self):
+        return self._fake_channel
+
+    # discord.py 2.1 以降は channel_id もプロパティなので、代入ではなく上書きする
+    @property
+    def channel_id(self):
+        return self._fake_channel.id
+
+    @property
+    def response(self):
+        return self._fake_response
+
+    @property
+    def followup(self):
+        return self._fake_followup
+
+    async def edit_original_response(self, content=None, view=None, **kwargs):
+        await self.message.edit(content=content, view=view)
+
+
+async def press(recorder, step, item, user, channel):
+    interaction = FakeInteraction(user, channel)
+    start = time.perf_counter()
+    try:
+        await item.callback(interaction)
+    except Exception as e:
+        recorder.errors += 1
+        print(f"[{step}] 例外: {e!r}")
+    elapsed = time.perf_counter() - start
+    acked_in = (interaction.acked_at or time.perf_counter()) - interaction.created_at_perf
+    recorder.add(step, elapsed, acked_in)
+    return interaction
+
+
+def find_item(view, custom_id=None):
+    items = [item for item in view.children if custom_id is None or item.custom_id == custom_id]
+    return random.choice(items) if items else None
+
+
+async def run_consult(recorder, user, channel, request_rate):
+    choice = bot.FoodChoiceView()
+    await press(recorder, "consult", find_item(choice, "consult"), user, channel)
+    genre_view = channel.last_view
+    genre = await press(recorder, "genre", find_item(genre_view), user, channel)
+    style = await press(recorder, "style", find_item(genre.response.view), user, channel)
+    request_view = style.response.view
+
+    if random.random() < request_rate:
+        # 要望をテキストで返信する（Gemini経由）
+        message = FakeMessage(channel, user, "辛いのがいい")
+        start = time.perf_counter()
+        try:
+            await bot.on_message(message)
+        except Exception as e:
+            recorder.errors += 1
+            print(f"[request_text] 例外: {e!r}")
+        recorder.add("request_text", time.perf_counter() - start, None)
+    else:
+        await press(recorder, "request_none", find_item(request_view), user, channel)
+
+
+async def run_gacha(recorder, user, channel, custom_id):
+    choice = bot.FoodChoiceView()
+    await press(recorder, custom_id, find_item(choice, custom_id), user, channel)
+
+
+def seed_memory(n_foods):
+    # --db なし：マスタと料理をメモリに直接入れる
+    genres = {str(i): f"ジャンル{i}" for i in range(1, 9)}
+    styles = {"1": "さっぱり", "2": "がっつり"}
+    bot.master_data.update(genres, styles)
+    rows = [
+        (f"料理{i}", random.choice("123"), random.choice(list(genres)), random.choice(list(styles)))
+        for i in range(n_foods)
+    ]
+    bot.sampler.rebuild(rows)
+    bot.history_rollup.rebuild([])
+    bot.caches_ready.set()
+
+
+def replace_db_writes(latency):
+    async def sink(records):
+        await asyncio.sleep(latency)
+
+    bot.food_queue.flush = sink
+    bot.history_queue.flush = sink
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(recorder, total_seconds, flows):
+    print()
+    print(f"{'step':>14} {'n':>6} {'p50(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9} {'>3s':>5}")
+    for step, values in recorder.latencies.items():
+        print(
+            f"{step:>14} {len(values):>6} {percentile(values, 0.5) * 1000:9.1f} "
+            f"{percentile(values, 0.99) * 1000:9.1f} {max(values) * 1000:9.1f} {recorder.missed.get(step, 0):>5}"
+        )
+    print()
+    print(f"フロー数: {flows}  経過: {total_seconds:.2f}s  スループット: {flows / total_seconds:.1f} flows/s")
+    print(f"3秒期限切れ: {sum(recorder.missed.values())}  例外: {recorder.errors}")
+
+
+async def main(args):
+    random.seed(args.seed)
+
+    # 楽天スタブを同じプロセスで立てる
+    stub_servers.RAKUTEN_LATENCY = args.rakuten_latency
+    runner = web.AppRunner(stub_servers.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.stub_port)
+    await site.start()
+    rakuten.RAKUTEN_API_URL = f"http://127.0.0.1:{args.stub_port}/recipe"
+    # スタブはアプリIDを見ないので、ダミーを入れておく
+    rakuten.RAKUTEN_APP_ID = rakuten.RAKUTEN_APP_ID or "load-test"
+    gemini.client.model = FakeGeminiModel(args.gemini_latency)
+
+    if args.db:
+        await bot.warm_caches()
+    else:
+        seed_memory(args.foods)
+        replace_db_writes(args.db_latency)
+    bot.food_queue.start()
+    bot.history_queue.start()
+    bot.deletions.start()
+
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    channels = [FakeChannel(10_000 + i, args.discord_latency) for i in range(args.channels)]
+
+    async def one_user(n):
+        async with semaphore:
+            user = FakeUser(1_000_000 + n)
+            # 同じチャンネルIDを共有しても、送られたViewはユーザーごとに分けて受け取る
+            shared = channels[n % len(channels)]
+            channel = FakeChannel(shared.id, shared.latency)
+            roll = random.random()
+            if roll < args.consult_rate:
+                await run_consult(recorder, user, channel, args.request_rate)
+            elif roll < args.consult_rate + (1 - args.consult_rate) / 2:
+                await run_gacha(recorder, user, channel, "buy")
+            else:
+                await run_gacha(recorder, user, channel, "cook")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_user(n) for n in range(args.users)))
+    total = time.perf_counter() - start
+
+    await bot.shutdown()
+    await runner.cleanup()
+    report(recorder, total, args.users)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="フードBotの負荷試験")
+    parser.add_argument("--users", type=int, default=200, help="試すユーザー（フロー）の数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時に動くユーザー数")
+    parser.add_argument("--channels", type=int, default=10, help="ユーザーを散らすチャンネル数")
+    parser.add_argument("--consult-rate", type=float, default=0.5, help="コンサルを選ぶ割合")
+    parser.add_argument("--request-rate", type=float, default=0.5, help="コンサルで要望を書く割合")
+    parser.add_argument("--gemini-latency", type=float, default=0.8)
+    parser.add_argument("--rakuten-latency", type=float, default=0.3)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.01, help="--db なしのときの書き込み時間")
+    parser.add_argument("--foods", type=int, default=10_000, help="--db なしのときの料理数")
+    parser.add_argument("--db", action="store_true", help="DATABASE_URL のPostgresを使う")
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
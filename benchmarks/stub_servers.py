@@ -0,0 +1,34 @@
+# 外部APIの代わりに立てるローカルスタブサーバー
+# 使い方: python benchmarks/stub_servers.py  → RAKUTEN_API_URL=http://127.0.0.1:8081/recipe で起動
+import os
+import asyncio
+
+from aiohttp import web
+
+STUB_HOST = os.environ.get("STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.environ.get("STUB_PORT", "8081"))
+RAKUTEN_LATENCY = float(os.environ.get("STUB_RAKUTEN_LATENCY", "0.2"))
+
+
+async def rakuten_recipe(request):
+    # 楽天レシピAPIと同じ形のJSONを返す。「なし」を含むキーワードは0件扱い
+    await asyncio.sleep(RAKUTEN_LATENCY)
+    keyword = request.query.get("keyword", "")
+    if "なし" in keyword:
+        return web.json_response({"result": []})
+    return web.json_response({
+        "result": [{
+            "recipeTitle": f"かんたん{keyword}",
+            "recipeUrl": f"https://example.com/recipe/{keyword}",
+        }]
+    })
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_get("/recipe", rakuten_recipe)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host=STUB_HOST, port=STUB_PORT)
@@ -1,136 +1,373 @@
 import os
+import asyncio
 import discord
 from discord.ext import commands
 from discord.ui import View, Button
 from discord import app_commands
 import traceback
 import sys
-import requests
 
-import psycopg2
+import time
+import uuid
 import random
+import signal
+import contextlib
+
+import db
+import cluster
+import gemini
+import metrics
+import tracing
+import rakuten
+import schema
+from food_sampler import FoodSampler, sampler, recent_results
+from dedup import DedupIndex, dedup_index, clean_name
+from history_rollup import history_rollup
+from master import master_data
+from prefetch import SuggestionPrefetcher
+from startup import StartupTimer, command_tree_hash
+from keep_alive import keep_alive
+from dispatch import dispatcher, deletions
+from sessions import sessions
+from write_queue import WriteBehindQueue
 
 # 環境変数読み込み
 TOKEN = os.environ.get("DISCORD_TOKEN")
-DATABASE_URL = os.environ.get("DATABASE_URL")
-
-import google.generativeai as genai
-
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+FORCE_COMMAND_SYNC = os.environ.get("FORCE_COMMAND_SYNC") == "1"
+# 要望つきコンサルでGeminiを待つ上限（超えたら先読みしておいた提案で返す）
+SUGGESTION_BUDGET = float(os.environ.get("SUGGESTION_BUDGET", "2.5"))
+# Geminiの返事を少しずつ表示するときの書き換え間隔（followup の枠 4回/5秒 に収まるように）
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+DISCORD_MESSAGE_LIMIT = 2000
+# LISTEN接続が切れたときのつなぎ直し間隔（失敗するたびに倍、上限あり）
+LISTEN_RECONNECT_DELAY = float(os.environ.get("LISTEN_RECONNECT_DELAY", "1"))
+LISTEN_RECONNECT_MAX_DELAY = float(os.environ.get("LISTEN_RECONNECT_MAX_DELAY", "60"))
 
 # Botの設定
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-genre_map={}
-style_map={}
+if cluster.SHARD_COUNT:
+    # main.py からワーカーとして起動されたときは担当シャードだけつなぐ
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=cluster.SHARD_COUNT,
+        shard_ids=cluster.SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+master_listener = None
+
+# 起動計測と、キャッシュが温まるまでガチャを受け付けないためのフラグ
+startup_timer = StartupTimer()
+caches_ready = asyncio.Event()
+commands_checked = False
+
+# DBへの書き込みは返信を待たせないようにキューに積んでまとめて書く
+food_queue = WriteBehindQueue("foods", db.insert_foods_batch)
+history_queue = WriteBehindQueue("consult_history", db.insert_consult_history_batch)
 
 # PostgreSQLからランダムで料理を取得
-def get_random_food(food_type: str):
+# user_id があれば、その人に最近出した料理は避ける
+async def get_random_food(food_type: str, user_id=None):
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        query = """
-            SELECT name FROM foods
-            WHERE type = %s OR type = '3'
-            ORDER BY RANDOM()
-            LIMIT 1
-        """
-        cursor.execute(query, (food_type,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        return result[0] if result else "候補が見つかりませんでした。"
+        if sampler.loaded:
+            result = sampler.pick_by_type(food_type, exclude=recent_results.get(user_id))
+        else:
+            result = await db.fetch_random_food(food_type)
+        recent_results.add(user_id, result)
+        return result if result else "候補が見つかりませんでした。"
     except Exception as e:
         print(f"DBエラー: {e}")
         traceback.print_exc()
         return "トラブルブリブリ"
 
+# ジャンル＆スタイル一致の料理をランダムで取得（見つからなければNone）
+async def get_random_food_by_genre_style(genre, style, user_id=None):
+    if sampler.loaded:
+        result = sampler.pick_by_genre_style(genre, style, exclude=recent_results.get(user_id))
+    else:
+        result = await db.fetch_random_food_by_genre_style(genre, style)
+    recent_results.add(user_id, result)
+    return result
+
 
 # 起動時の処理
 @bot.event
 async def on_ready():
+    global commands_checked
     print("🔔 on_ready() が呼ばれました")
-    await bot.tree.sync()
-    await load_master()
+    # 再接続のたびに呼ばれるので、起動処理は最初の1回だけ
+    if commands_checked:
+        return
+    startup_timer.mark("gateway_ready")
+    # コマンドは全シャード共通なので、同期は1プロセスだけでいい
+    if cluster.is_primary():
+        async with startup_timer.phase("command_sync"):
+            await sync_commands_if_changed()
+    commands_checked = True
+    await caches_ready.wait()
+    startup_timer.mark_ready()
     print(f"Bot起動完了: {bot.user}")
-    
-async def load_master():
-    global genre_map, style_map 
+
+# コマンド定義が前回の同期から変わったときだけ tree.sync() する
+async def sync_commands_if_changed():
+    current = command_tree_hash(bot.tree)
     try:
-        print("🔧 DB接続開始")
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
+        synced = await db.get_meta("command_tree_hash")
+    except Exception as e:
+        print(f"コマンドハッシュ取得失敗: {e}")
+        synced = None
+    if synced == current and not FORCE_COMMAND_SYNC:
+        print("✅ コマンド定義に変更なし（sync省略）")
+        return
+    try:
+        await bot.tree.sync()
+        print("✅ コマンド同期完了")
+    except Exception as e:
+        print(f"❌ コマンド同期失敗: {e}")
+        return
+    try:
+        await db.set_meta("command_tree_hash", current)
+    except Exception as e:
+        print(f"コマンドハッシュ保存失敗: {e}")
+
+# ゲートウェイ接続と並行してキャッシュを温める
+async def warm_caches():
+    async def timed(name, coro):
+        async with startup_timer.phase(name):
+            await coro
+
+    try:
+        # テーブルが揃ってから読み込む
+        await timed("schema", migrate_schema())
+        await asyncio.gather(
+            timed("master", load_master()),
+            timed("master_listener", start_master_listener()),
+            timed("foods", load_foods()),
+            timed("recipe_cache", load_recipe_cache()),
+            timed("history_rollup", load_history_rollup()),
+        )
+    finally:
+        startup_timer.mark("caches_warm")
+        caches_ready.set()
+    # インデックスは大きい表だと作るのに何分もかかるので、ガチャを受け付け始めてから作る
+    await build_indexes()
+
+async def migrate_schema():
+    try:
+        await schema.migrate_schema()
+    except Exception as e:
+        print(f"❌ マイグレーション失敗: {e}")
 
-        cursor.execute("SELECT code, name FROM genres")
-        genre_map = {code: name for code, name in cursor.fetchall()}
+# インデックスを作るのは1プロセスだけ。ほかは状態を報告するだけ
+async def build_indexes():
+    try:
+        if cluster.is_primary():
+            await schema.build_indexes()
+        else:
+            await schema.check_indexes()
+    except Exception as e:
+        print(f"❌ インデックス確認失敗: {e}")
 
-        cursor.execute("SELECT code, name FROM styles")
-        style_map = {code: name for code, name in cursor.fetchall()}
+# キャッシュ準備中ならTrueを返して、ガチャを断る
+async def reject_if_warming(interaction):
+    if caches_ready.is_set():
+        return False
+    await interaction.response.send_message("起動準備中です。少し待ってね！", ephemeral=True)
+    return True
 
-        cursor.close()
-        conn.close()
-        print("✅ DBマスタ取得成功")
+async def load_master():
+    try:
+        print("🔧 DB接続開始")
+        genres, styles = await db.fetch_master()
+        if master_data.update(genres, styles):
+            print(f"✅ DBマスタ取得成功（version {master_data.snapshot.version}）")
+        else:
+            print("✅ DBマスタ取得成功（変更なし）")
     except Exception as e:
         print(f"❌ DBマスタ取得失敗: {e}")
 
+# genres / styles の変更をLISTENして、再起動なしでマスタを入れ替える
+async def start_master_listener():
+    global master_listener
+    if master_listener is not None and not master_listener.is_closed():
+        return
+    try:
+        master_listener = await db.listen(db.MASTER_CHANNEL, on_master_changed)
+        master_listener.add_termination_listener(on_listener_terminated)
+        print("✅ マスタ変更の監視開始")
+        if cluster.ENABLED:
+            await master_listener.add_listener(cluster.EVENTS_CHANNEL, cluster.handle_event)
+            print(f"✅ ワーカー間通知の監視開始（worker {cluster.WORKER_ID}）")
+    except Exception as e:
+        print(f"❌ マスタ変更の監視開始失敗: {e}")
+
+# Postgresの再起動などでLISTEN接続が切れたら、つなぎ直してから読み直す
+def on_listener_terminated(conn):
+    if conn is not master_listener:
+        # 終了処理で閉じたとき
+        return
+    print("⚠️ LISTEN接続が切れました。つなぎ直します")
+    asyncio.get_running_loop().create_task(reconnect_master_listener())
+
+async def reconnect_master_listener():
+    delay = LISTEN_RECONNECT_DELAY
+    while not bot.is_closed():
+        await start_master_listener()
+        if master_listener is not None and not master_listener.is_closed():
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, LISTEN_RECONNECT_MAX_DELAY)
+    else:
+        return
+    # 切れていたあいだの通知は届いていないので、DBから読み直す
+    await load_master()
+    if cluster.ENABLED:
+        await load_foods()
+        await load_history_rollup()
+
+def on_master_changed(conn, pid, channel, payload):
+    print(f"🔔 マスタ変更通知: {payload}")
+    asyncio.get_running_loop().create_task(load_master())
+
+# 作り直し中に追加された料理（作り直しごとに1つ。できあがった索引に足してから入れ替える）
+foods_added_during_rebuild = []
+
+# foodsテーブルを抽選用インデックスに読み込む
+# 件数が多いと数秒かかるので、イベントループを止めないように別スレッドで作ってから入れ替える
+async def load_foods():
+    added = []
+    foods_added_during_rebuild.append(added)
+    try:
+        rows = await db.fetch_all_foods()
+        new_sampler, new_index = await asyncio.to_thread(build_food_indexes, rows)
+        for name, genre, style in added:
+            if new_index.find(name, genre, style) is None:
+                new_sampler.add(name, "3", genre, style)
+                new_index.add(name, genre, style)
+        sampler.swap(new_sampler)
+        dedup_index.swap(new_index)
+        print(f"✅ 料理インデックス作成成功: {len(sampler)}件")
+    except Exception as e:
+        print(f"❌ 料理インデックス作成失敗: {e}")
+    finally:
+        foods_added_during_rebuild.remove(added)
+
+def build_food_indexes(rows):
+    new_sampler = FoodSampler()
+    new_sampler.rebuild(rows)
+    new_index = DedupIndex()
+    new_index.rebuild(rows)
+    return new_sampler, new_index
+
+def add_food_to_indexes(name, genre, style):
+    sampler.add(name, "3", genre, style)
+    dedup_index.add(name, genre, style)
+    for added in foods_added_during_rebuild:
+        added.append((name, genre, style))
+
 @bot.tree.command(name="genres", description="ジャンル一覧を表示します")
+@metrics.track_command("genres")
 async def list_genres(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    if not genre_map:
+    if not master_data.snapshot.genres:
         await load_master()
-    text = "📚 登録ジャンル一覧：\n" + "\n".join([f"{code} = {name}" for code, name in genre_map.items()])
-    await interaction.followup.send(text, ephemeral=True)
+    await interaction.followup.send(master_data.snapshot.genres_text, ephemeral=True)
 
 @bot.tree.command(name="styles", description="スタイル一覧を表示します")
+@metrics.track_command("styles")
 async def list_styles(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    if not style_map:
+    if not master_data.snapshot.styles:
         await load_master()
-    text = "🎨 登録スタイル一覧：\n" + "\n".join([f"{code} = {name}" for code, name in style_map.items()])
-    await interaction.followup.send(text, ephemeral=True)
+    await interaction.followup.send(master_data.snapshot.styles_text, ephemeral=True)
 
 @bot.tree.command(name="reload", description="ジャンル・スタイルのマスタ情報を再読み込みします")
+@metrics.track_command("reload")
 async def reload_master(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
     try:
         await load_master()
+        await load_foods()
         await interaction.followup.send("✅ マスタ情報を再取得しました！", ephemeral=True)
     except Exception as e:
         print(f"/reloadでのマスタ再取得失敗: {e}")
         await interaction.followup.send("❌ マスタ情報の再取得に失敗しました…", ephemeral=True)  
 
+# 過去のおすすめ用の集計を読み込む
+async def load_history_rollup():
+    try:
+        history_rollup.rebuild(await db.fetch_history_rollup())
+        print(f"✅ 履歴集計読み込み成功: {len(history_rollup.users)}人")
+    except Exception as e:
+        print(f"❌ 履歴集計読み込み失敗: {e}")
+
+@bot.tree.command(name="rebuild_history", description="過去のおすすめ用の集計をconsult_historyから作り直します")
+@app_commands.default_permissions(administrator=True)
+@metrics.track_command("rebuild_history")
+async def rebuild_history(interaction: discord.Interaction):
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    try:
+        # メモリには入っていて書き込み待ちの分が消えないように、先に書き切る
+        await history_queue.sync()
+        await db.rebuild_history_rollup()
+        history_rollup.rebuild(await db.fetch_history_rollup())
+        await interaction.followup.send(f"✅ 履歴集計を作り直しました！（{len(history_rollup.users)}人）", ephemeral=True)
+    except Exception as e:
+        print(f"/rebuild_historyでの集計作り直し失敗: {e}")
+        await interaction.followup.send("❌ 履歴集計の作り直しに失敗しました…", ephemeral=True)
+
+@bot.tree.command(name="check_history", description="過去のおすすめ用の集計がconsult_historyと一致しているか確認します")
+@app_commands.default_permissions(administrator=True)
+@metrics.track_command("check_history")
+async def check_history(interaction: discord.Interaction):
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    try:
+        table_mismatches = await db.check_history_rollup()
+        memory_mismatches = len(history_rollup.diff(await db.fetch_history_rollup()))
+    except Exception as e:
+        print(f"/check_historyでの確認失敗: {e}")
+        await interaction.followup.send("❌ 履歴集計の確認に失敗しました…", ephemeral=True)
+        return
+    await interaction.followup.send(
+        f"集計テーブルとのずれ: {table_mismatches}件\n"
+        f"メモリとのずれ: {memory_mismatches}件\n"
+        f"書き込み待ち: {len(history_queue)}件",
+        ephemeral=True,
+    )
+
 # ボタンクラス定義
 class FoodButton(Button):
+    @metrics.track_button()
     async def callback(self, interaction: discord.Interaction):
+        if await reject_if_warming(interaction):
+            return
         user_id = str(interaction.user.id)
-        
-        # 保険：user_statesがなければ初期化（またはエラーメッセージにしてもOK）
-        state = user_states.setdefault(user_id, {})
+        session = sessions.get(interaction.channel_id, user_id)
 
         await interaction.response.defer(ephemeral=False)
         
-        # 保険：新規ユーザーが途中から押せないように
-        if len(user_states) >= 3 and user_id not in user_states:
-            await interaction.followup.send("他のユーザーが操作中です。待ってね～。", ephemeral=True)
-            return
-        
         if self.custom_id == "buy":
-            food = get_random_food("1")
-            await interaction.followup.send(f"{food}！", view=FoodDetailView(food),ephemeral=False)
-            if "mode" not in state or state["mode"] != "consult":
-                user_states.pop(user_id, None)
+            food = await get_random_food("1", user_id)
+            await dispatcher.followup(interaction, f"{food}！", view=FoodDetailView(food))
+            if session and session.mode != "consult":
+                sessions.end(session)
         elif self.custom_id == "cook":
-            food = get_random_food("2")
-            recipe = get_recipe_from_rakuten(food)
+            food = await get_random_food("2", user_id)
+            recipe = await get_recipe_from_rakuten(food)
             recipe_url = recipe[1] if recipe else None
-            await interaction.followup.send(f"{food}！", view=RecipeView(food=food, recipe_url=recipe_url),ephemeral=False)
-            if "mode" not in state or state["mode"] != "consult":
-                user_states.pop(user_id, None)
+            await dispatcher.followup(interaction, f"{food}！", view=RecipeView(food=food, recipe_url=recipe_url))
+            if session and session.mode != "consult":
+                sessions.end(session)
         elif self.custom_id == "consult":
-            await interaction.channel.send("ジャンルを選んで！", view=GenreView(),delete_after=60)
-            state["mode"] = "consult"   # 継続中の状態は残す
+            session = sessions.get_or_start(interaction.channel_id, user_id, "consult")
+            session.mode = "consult"   # 継続中の状態は残す
+            sessions.touch(session)
+            # ここで送ったメッセージを、結果が出るまで書き換えていく
+            session.message = await dispatcher.followup(
+                interaction, "ジャンルを選んで！", view=GenreView(), delete_after=60
+            )
 
 # ビュー定義（3つのボタンを並べる）
 class FoodChoiceView(View):
@@ -149,39 +386,39 @@ async def on_message(message):
 
     user_id = str(message.author.id)
 
-    # 要望返信の処理（直前のコンサルがあれば）
-    if user_id in user_states and "genre" in user_states[user_id] and "style" in user_states[user_id] and "request" not in user_states[user_id]:
-        user_states[user_id]["request"] = message.content
-        await message.channel.send("🤔 考え中です...",delete_after=30)
-        await show_consult_result(message.channel, user_id)
+    # 要望返信の処理（このチャンネルで直前のコンサルがあれば）
+    session = sessions.get(message.channel.id, user_id)
+    if session and session.waiting_for_request():
+        session.request = message.content
+        session.has_request = True
+        with tracing.span("message:consult_request", user=user_id, channel=message.channel.id):
+            session.message = await dispatcher.update(
+                message.channel, session.message, "🤔 考え中です...", delete_after=30
+            )
+            await show_consult_result(message.channel, session)
         return
 
     # メンションされたら
     if bot.user.mentioned_in(message):
-        if "responded" in user_states.get(user_id, {}):
-            return  # 既に反応済み
+        if not caches_ready.is_set():
+            await dispatcher.send(message.channel, "起動準備中です。少し待ってね！", delete_after=30)
+            return
         if "過去のおすすめ" in message.content:
             await show_user_history(message.channel, user_id)
             return
-        
-        if len(user_states) >= 3 and str(message.author.id) not in user_states:
-            await message.channel.send("現在対応できる人数が上限に達しています。少し待ってね！",delete_after=30)
-            return
+
         # ユーザーを仮で登録（操作開始扱い）
-        user_states[str(message.author.id)] = {"mode": "start"}
-        await message.channel.send("どれにする？", view = FoodChoiceView(),delete_after=60)
+        sessions.start(message.channel.id, user_id, "start")
+        await dispatcher.send(message.channel, "どれにする？", view=FoodChoiceView(), delete_after=60)
         return
 
     await bot.process_commands(message)
 
-# ユーザー別に状態を保持する辞書（簡易的）
-user_states = {}
-
 # ジャンル選択用ビュー
 class GenreView(View):
     def __init__(self):
         super().__init__(timeout=60)
-        for code, name in genre_map.items():
+        for name, code in master_data.snapshot.genre_buttons:
             self.add_item(GenreButton(label=name, genre_code=code))
 
 class GenreButton(Button):
@@ -189,16 +426,22 @@ class GenreButton(Button):
         super().__init__(label=label, style=discord.ButtonStyle.primary)
         self.genre_code = genre_code
 
+    @metrics.track_button("GenreButton")
     async def callback(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
-        user_states.setdefault(user_id, {})["genre"] = self.genre_code
-        await interaction.response.send_message("さっぱり or がっつり？", view=StyleView(), ephemeral=False,delete_after=60)
+        session = sessions.get_or_start(interaction.channel_id, user_id, "consult")
+        session.genre = self.genre_code
+        session.message = interaction.message
+        sessions.touch(session)
+        # 新しく送らずに、押されたメッセージをそのまま書き換える
+        await interaction.response.edit_message(content="さっぱり or がっつり？", view=StyleView())
+        deletions.schedule(interaction.message, 60)
 
 # スタイル選択用ビュー
 class StyleView(View):
     def __init__(self):
         super().__init__(timeout=60)
-        for code, name in style_map.items():
+        for name, code in master_data.snapshot.style_buttons:
             self.add_item(StyleButton(label=name, style_code=code))
 
 
@@ -207,23 +450,26 @@ class StyleButton(Button):
         super().__init__(label=label, style=discord.ButtonStyle.success)
         self.style_code = style_code
 
+    @metrics.track_button("StyleButton")
     async def callback(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
-        if user_id not in user_states:
-            await interaction.response.send_message("先にジャンルを選んでください！", ephemeral=False,delete_after=60)
+        session = sessions.get(interaction.channel_id, user_id)
+        if session is None or session.genre is None:
+            await interaction.response.send_message("先にジャンルを選んでください！", ephemeral=True)
             return
 
-        user_states[user_id]["style"] = self.style_code
-        
-         # レスポンス予約（これをやらないと後でエラーになる）
-        await interaction.response.defer(ephemeral=False)
+        session.style = self.style_code
+        session.message = interaction.message
+        sessions.touch(session)
+        # 要望を書いているあいだに、この組み合わせの提案を先読みしておく
+        prefetcher.note_selected(session.genre, session.style)
 
         # 要望入力
-        await interaction.channel.send(
-            "要望があればこのメッセージに返信して!",
+        await interaction.response.edit_message(
+            content="要望があればこのメッセージに返信して!",
             view=RequestView(interaction.message.id),
-            delete_after=30
         )
+        deletions.schedule(interaction.message, 60)
         
 
 class RequestView(View):
@@ -236,69 +482,56 @@ class RequestNoneButton(Button):
         super().__init__(label="なし", style=discord.ButtonStyle.secondary)
         self.original_message_id = original_message_id
 
+    @metrics.track_button("RequestNoneButton")
     async def callback(self, interaction: discord.Interaction):
         user_id = str(interaction.user.id)
-        user_states[user_id]["request"] = None
-        # 応答予約（これをしないと followup.send が失敗する）
-        await interaction.response.defer(ephemeral=False)
+        session = sessions.get(interaction.channel_id, user_id)
+        if session is None or not session.waiting_for_request():
+            await interaction.response.send_message("先にジャンルとスタイルを選んでください！", ephemeral=True)
+            return
+        session.request = None
+        session.has_request = True
+        # 応答予約も兼ねて、同じメッセージを「考え中」にしておく
+        await interaction.response.edit_message(content="🤔 考え中です...", view=None)
 
         # 結果を送信
-        await show_consult_result(interaction, user_id)
+        await show_consult_result(interaction, session)
         
-async def show_consult_result(target, user_id):
-    state = user_states.get(user_id)
-    genre = state["genre"]
-    style = state["style"]
-    request = state.get("request")
+async def show_consult_result(target, session):
+    user_id = session.user_id
+    genre = session.genre
+    style = session.style
+    request = session.request
 
     if request is None or request.strip().lower() == "なし":
         # DBからジャンル＆スタイル一致の料理を提示
         try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cursor = conn.cursor()
-            query = """
-                SELECT name FROM foods
-                WHERE genre = %s AND style = %s
-                ORDER BY RANDOM()
-                LIMIT 1
-            """
-            cursor.execute(query, (genre, style))
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            response = f"ほな「{result[0]}」かも！" if result else "条件に合う料理が見つかりませんでした。"
-            result_food=result[0]
-            successflg=True
+            result = await get_random_food_by_genre_style(genre, style, user_id)
+            response = f"ほな「{result}」かも！" if result else "条件に合う料理が見つかりませんでした。"
+            result_food=result
+            successflg=result is not None
         except Exception as e:
             print(f"DBエラー: {e}")
             response = "トラブルブリブリ"
             successflg=False
     else:
-        # Gemini API呼び出し
-        suggestion = get_gemini_suggestion(genre, style, request)
+        # Gemini API呼び出し（遅ければ先読み分で返す）
+        suggestion, used_request = await get_suggestion_within_budget(genre, style, request)
         if suggestion:
+            suggestion = insert_food_if_new(suggestion, genre, style) or suggestion
             response = f"ほな{suggestion}でどうや！"
-            insert_food_if_new(suggestion, genre, style)
+            if not used_request:
+                # 先読み分は要望を見ていないので、黙って要望どおりのふりをしない
+                response += "\n（要望を考えるのが間に合わなかったので、ジャンルとスタイルだけで選んだよ）"
             result_food=suggestion
             successflg=True
         else:
             # フォールバックでDB検索
             try:
-                conn = psycopg2.connect(DATABASE_URL)
-                cursor = conn.cursor()
-                query = """
-                    SELECT name FROM foods
-                    WHERE genre = %s AND style = %s
-                    ORDER BY RANDOM()
-                    LIMIT 1
-                """
-                cursor.execute(query, (genre, style))
-                result = cursor.fetchone()
-                cursor.close()
-                conn.close()
-                response = f"「{result[0]}」はいかがでしょう？" if result else "条件に合う料理が見つかりませんでした。"   
-                result_food=result[0]
-                successflg=True
+                result = await get_random_food_by_genre_style(genre, style, user_id)
+                response = f"「{result}」はいかがでしょう？" if result else "条件に合う料理が見つかりませんでした。"   
+                result_food=result
+                successflg=result is not None
             except Exception as e:
                 print(f"[DB検索も失敗] {e}")
                 response = "トラブルブリブリ" 
@@ -306,108 +539,152 @@ async def show_consult_result(target, user_id):
 
     # 提案履歴をDBに保存
     if successflg:
-        try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cursor = conn.cursor()
-            cursor.execute("""
-    INSERT INTO consult_history (user_id, genre, style, request_text, result_text, result_food)
-    VALUES (%s, %s, %s, %s, %s, %s)
-""", (
-    user_id, genre, style, request, response, result_food
-))
-            conn.commit()
-            cursor.close()
-            conn.close()
-        except Exception as e:
-            print(f"履歴保存失敗: {e}")
+        history_queue.put((uuid.uuid4(), user_id, genre, style, request, response, result_food))
+        history_rollup.add(user_id, result_food, genre, style)
+        cluster.publish("history", user_id=user_id, food=result_food, genre=genre, style=style)
 
+    # 結果はコンサルのメッセージに書いて、消さずに残す
     if isinstance(target, discord.Interaction):
-        await target.followup.send(response,view=FoodDetailView(result_food))
+        await target.edit_original_response(content=response, view=FoodDetailView(result_food))
+        deletions.cancel(target.message)
     else:
-        await target.send(response,view=FoodDetailView(result_food))
+        message = await dispatcher.update(target, session.message, response, view=FoodDetailView(result_food))
+        deletions.cancel(message)
 
     # 終わったらユーザー状態クリア
-    del user_states[user_id]
+    sessions.end(session)
 
-def get_gemini_suggestion(genre_code, style_code, request_text):
-    genre = genre_map.get(genre_code, genre_code)
-    style = style_map.get(style_code, style_code)
+async def get_gemini_suggestion(genre_code, style_code, request_text):
+    snapshot = master_data.snapshot
+    genre = snapshot.genre_name(genre_code)
+    style = snapshot.style_name(style_code)
 
     prompt = f"""ユーザーが「{genre}」を食べたい気分で、「{style}」な料理が食べたいと言っています。
 また、以下の要望があります。「{request_text}」
 おすすめの料理を1つ、簡潔に料理名だけ教えてください。"""
 
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
-        suggestion = response.text.strip()
+        suggestion = await gemini.client.generate(prompt)
         print("🟢 Gemini APIの返答：", suggestion)
         return suggestion
     except Exception as e:
         print(f"[Gemini API失敗] {e}")
         return None  # フォールバック用
     
+# 要望つきのGemini提案を SUGGESTION_BUDGET 秒だけ待つ。間に合わなければ先読み分を使う
+# (料理名, 要望を反映したか) を返す。先読み分は (genre, style) だけで選んだものなので False
+async def get_suggestion_within_budget(genre, style, request):
+    task = asyncio.get_running_loop().create_task(get_gemini_suggestion(genre, style, request))
+    done, _ = await asyncio.wait({task}, timeout=SUGGESTION_BUDGET)
+    if done and task.result():
+        return task.result(), True
+
+    prefetched = prefetcher.take(genre, style)
+    if prefetched is None:
+        return await task, True
+    if not done:
+        # 遅れて返ってきた提案も料理として登録しておく
+        def register_late(t):
+            if not t.cancelled() and t.result():
+                insert_food_if_new(t.result(), genre, style)
+        task.add_done_callback(register_late)
+    print(f"🟡 先読みの提案を使用（要望は反映なし）: {prefetched}")
+    return prefetched, False
+
+def make_prefetch_prompt(genre_code, style_code, n):
+    snapshot = master_data.snapshot
+    genre = snapshot.genre_name(genre_code)
+    style = snapshot.style_name(style_code)
+    return f"""「{genre}」で「{style}」な料理のおすすめを{n}個、1行に1つずつ料理名だけ教えてください。
+番号や説明はつけないでください。"""
+
+# 先読みで作った料理はまとめてfoodsに登録する
+def on_prefetched(genre, style, names):
+    for name in names:
+        insert_food_if_new(name, genre, style)
+
+# 先読みはライブの要望より後回しにする（枠が足りないときは見送る）
+prefetcher = SuggestionPrefetcher(gemini.client.generate_background, make_prefetch_prompt, on_prefetched)
+
 # Geminiの回答をfoodsテーブルにも追加    
+# 登録した（または既にあった）料理名を返す
 def insert_food_if_new(name, genre, style):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-
-        # 重複チェック（同じ名前・ジャンル・スタイルがすでにあるか）
-        cursor.execute("""
-            SELECT 1 FROM foods WHERE name = %s AND genre = %s AND style = %s
-        """, (name, genre, style))
-        exists = cursor.fetchone()
-
-        if not exists:
-            cursor.execute("""
-                INSERT INTO foods (name, type, genre, style) VALUES (%s, '3', %s, %s)
-            """, (name, genre, style))
-            conn.commit()
-
-        cursor.close()
-        conn.close()
-        print(f"✅ foodsに料理「{name}」を登録しました")
-    except Exception as e:
-        print(f"❌ foodsへの登録失敗: {e}")
-
+    # 重複チェック（表記ゆれも同じ料理とみなす）。DBへはキュー経由で書く
+    name = clean_name(name)
+    if not name:
+        return None
+    existing = dedup_index.find(name, genre, style)
+    if existing is not None:
+        return existing
+    add_food_to_indexes(name, genre, style)
+    food_queue.put((name, genre, style))
+    cluster.publish("food", name=name, genre=genre, style=style)
+    print(f"✅ foodsに料理「{name}」を登録しました")
+    return name
+
+
+# 他のワーカーで登録された料理・履歴をこのプロセスのキャッシュにも反映する
+@cluster.on("food")
+def on_cluster_food(name, genre, style):
+    if dedup_index.find(name, genre, style) is None:
+        add_food_to_indexes(name, genre, style)
+
+@cluster.on("history")
+def on_cluster_history(user_id, food, genre, style):
+    history_rollup.add(user_id, food, genre, style)
 
 # おすすめ表示    
 async def show_user_history(channel, user_id):
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT result_food, genre, style, COUNT(*) AS freq
-            FROM consult_history
-            WHERE user_id = %s AND result_food IS NOT NULL
-            GROUP BY result_food, genre, style
-            ORDER BY freq DESC
-            LIMIT 3
-        """, (user_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        if history_rollup.loaded:
+            rows = history_rollup.top(user_id)
+        else:
+            rows = await db.fetch_user_top_foods(user_id)
     except Exception as e:
         print(f"履歴取得失敗: {e}")
-        await channel.send("履歴を取得できませんでした。",delete_after=30)
+        await dispatcher.send(channel, "履歴を取得できませんでした。", delete_after=30)
         return
 
     if not rows:
-        await channel.send("履歴が見つかりませんでした。",delete_after=30)
+        await dispatcher.send(channel, "履歴が見つかりませんでした。", delete_after=30)
         return
 
+    snapshot = master_data.snapshot
     marks = ["!!!", "!!", "!"]
     lines = []
     for i, (food, genre, style, _) in enumerate(rows):
-        genre_name = genre_map.get(genre, genre)
-        style_name = style_map.get(style, style)
-        lines.append(f"{i+1}位： {food}{marks[i]} {{{genre_name}（{style_name}）}}")
-
-    await channel.send("\n".join(lines))
-
-class RecipeView(View):
+        genre_name = snapshot.genre_name(genre)
+        style_name = snapshot.style_name(style)
+        mark = marks[i] if i < len(marks) else ""
+        lines.append(f"{i+1}位： {food}{mark} {{{genre_name}（{style_name}）}}")
+
+    await dispatcher.send(channel, "\n".join(lines))
+
+# Geminiのストリーミング返信を出すボタンを持つView。タイムアウトしたら生成途中でも止める
+class StreamingView(View):
+    def __init__(self, timeout=60):
+        super().__init__(timeout=timeout)
+        self.streams = set()
+
+    async def run_stream(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.streams.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Viewのタイムアウトで止めたとき（呼び出し元ごとのキャンセルでないとき）は、表示済みの分だけ残して終わる
+            if asyncio.current_task().cancelling():
+                raise
+            return None
+        finally:
+            self.streams.discard(task)
+
+    async def on_timeout(self):
+        for task in list(self.streams):
+            task.cancel()
+
+class RecipeView(StreamingView):
     def __init__(self, food=None,recipe_url=None):
         super().__init__(timeout=60)
         self.food = food  # ← 安全のため保持
@@ -423,56 +700,100 @@ class RecipeButton(Button):
         super().__init__(label="レシピ知りたい！", style=discord.ButtonStyle.secondary)
         self.food = food
 
+    @metrics.track_button("RecipeButton")
     async def callback(self, interaction: discord.Interaction):
         print(f"🍳 レシピ検索対象: {self.food}")  # ← これでデバッグログ出そう
         if not self.food:
             await interaction.response.send_message("料理名が見つかりませんでした！", ephemeral=True)
             return
 
+        # 応答予約（楽天・Geminiが遅くても3秒の期限に間に合わせる）
+        await interaction.response.defer(ephemeral=False)
+
         # 楽天API呼び出し
-        recipe = get_recipe_from_rakuten(self.food)
+        recipe = await get_recipe_from_rakuten(self.food)
         if recipe:
             title, url = recipe
-            await interaction.response.send_message(f"✅ {title}\n{url}", ephemeral=False)
+            await dispatcher.followup(interaction, f"✅ {title}\n{url}")
         else:
-            # Geminiで補完
-            fallback = get_gemini_recipe(self.food)
-            if fallback:
-                await interaction.response.send_message(f"{self.food}のつくりかた！：{fallback}", ephemeral=False)
-            else:
-                await interaction.response.send_message("🥲 該当レシピが見つかりませんでした。がんばって作ろう！", ephemeral=False)
-
-
-def get_recipe_from_rakuten(food_name):
-    app_id = os.environ.get("RAKUTEN_APP_ID")
-    url = f"https://app.rakuten.co.jp/services/api/Recipe/RecipeKeywordSearch/20170426"
-    params = {
-        "format": "json",
-        "applicationId": app_id,
-        "keyword": food_name
-    }
+            # Geminiで補完（書けたところから表示する）
+            await self.view.run_stream(stream_gemini_reply(
+                interaction,
+                gemini_recipe_prompt(self.food),
+                lambda text: f"{self.food}のつくりかた！：{text}",
+                "🥲 該当レシピが見つかりませんでした。がんばって作ろう！",
+            ))
+
 
+async def get_recipe_from_rakuten(food_name):
+    on_fetched = save_recipe_cache if rakuten.RECIPE_CACHE_PERSIST else None
     try:
-        response = requests.get(url, params=params)
-        data = response.json()
-        if data.get("result"):
-            recipe = data["result"][0]
-            return recipe["recipeTitle"], recipe["recipeUrl"]
+        return await rakuten.get_recipe(food_name, on_fetched=on_fetched)
+    except asyncio.TimeoutError:
+        print(f"楽天APIタイムアウト: {food_name}")
     except Exception as e:
         print(f"楽天APIエラー: {e}")
     return None
 
-def get_gemini_recipe(food_name):
+# レシピ検索結果をDBにも残す（失敗してもキャッシュには入る）
+async def save_recipe_cache(food_name, recipe):
     try:
-        prompt = f"{food_name} のレシピを簡単に教えてください。材料と手順を2文以内で説明してください。"
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        await db.upsert_recipe_cache(food_name, recipe)
     except Exception as e:
-        print(f"[Gemini代替失敗] {e}")
-        return None
+        print(f"レシピキャッシュ保存失敗: {e}")
+
+async def load_recipe_cache():
+    if not rakuten.RECIPE_CACHE_PERSIST:
+        return
+    try:
+        rows = await db.fetch_recipe_cache(rakuten.RECIPE_CACHE_TTL)
+        rakuten.warm_cache(rows)
+        print(f"✅ レシピキャッシュ読み込み成功: {len(rakuten.recipe_cache)}件")
+    except Exception as e:
+        print(f"❌ レシピキャッシュ読み込み失敗: {e}")
+
+def gemini_recipe_prompt(food_name):
+    return f"{food_name} のレシピを簡単に教えてください。材料と手順を2文以内で説明してください。"
+
+# Geminiの返事をストリーミングで表示する
+# 最初のかたまりが届いたら送って、あとは STREAM_EDIT_INTERVAL ごとに同じメッセージを書き換える
+async def stream_gemini_reply(interaction, prompt, render, fallback, delete_after=None):
+    message = None
+    text = shown = None
+    last_edit = 0.0
+    failed = False
+    cancelled = None
+    try:
+        async with contextlib.aclosing(gemini.client.stream_cached(prompt)) as stream:
+            async for text in stream:
+                content = render(text.strip())[:DISCORD_MESSAGE_LIMIT]
+                if message is None:
+                    message = await dispatcher.followup(interaction, content, delete_after=delete_after)
+                elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    await dispatcher.edit_followup(interaction, message, content)
+                else:
+                    continue
+                shown, last_edit = text, time.monotonic()
+    except asyncio.CancelledError as e:
+        # Viewのタイムアウトなどで止められても、届いていた分は最後に書いてから止まる
+        cancelled = e
+        failed = True
+    except Exception as e:
+        print(f"[Geminiストリーミング失敗] {e}")
+        failed = True
 
-class FoodDetailView(View):
+    try:
+        if message is None:
+            await dispatcher.followup(interaction, fallback, delete_after=delete_after)
+        elif text != shown or failed:
+            # 間引いた残りを最後にまとめて反映する（途中で止まったら「…」をつける）
+            content = render(text.strip())[:DISCORD_MESSAGE_LIMIT - 1] + ("…" if failed else "")
+            await dispatcher.edit_followup(interaction, message, content)
+    finally:
+        if cancelled is not None:
+            raise cancelled
+
+class FoodDetailView(StreamingView):
     def __init__(self, food_name):
         super().__init__(timeout=60)
         self.add_item(FoodDetailButton(food_name))
@@ -482,21 +803,89 @@ class FoodDetailButton(Button):
         super().__init__(label="それなに～？", style=discord.ButtonStyle.secondary)
         self.food_name = food_name
 
+    @metrics.track_button("FoodDetailButton")
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        explanation = get_food_description(self.food_name)
-        await interaction.channel.send(explanation or "ごめん、うまく説明できんかった🥲",delete_after=60)
+        await self.view.run_stream(stream_gemini_reply(
+            interaction,
+            food_description_prompt(self.food_name),
+            lambda text: f"{self.food_name}：{text}",
+            "ごめん、うまく説明できんかった🥲",
+            delete_after=60,
+        ))
 
-def get_food_description(food_name):
-    prompt = f"「{food_name}」ってどんな料理か、簡単に説明してください。"
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
-        return f"{food_name}：{response.text.strip()}"
-    except Exception as e:
-        print(f"[Gemini料理説明失敗] {e}")
-        return None
+def food_description_prompt(food_name):
+    return f"「{food_name}」ってどんな料理か、簡単に説明してください。"
 
 # Bot起動
+async def start_bot():
+    loop = asyncio.get_running_loop()
+    # docker stop などのSIGTERMでも書き込みキューを流してから終わる
+    loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    food_queue.start()
+    history_queue.start()
+    deletions.start()
+    register_metrics()
+    web_runner = await keep_alive(is_live, is_ready)
+    lag_task = loop.create_task(metrics.monitor_event_loop())
+    tracing.blocking_detector.start()
+    warm_task = loop.create_task(warm_caches())
+    prefetch_task = loop.create_task(prefetcher.refill_popular())
+    try:
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        warm_task.cancel()
+        prefetch_task.cancel()
+        lag_task.cancel()
+        tracing.blocking_detector.stop()
+        await web_runner.cleanup()
+        await shutdown()
+
+# ヘルスチェック用：ゲートウェイにつながっているか
+def is_live():
+    return not bot.is_closed()
+
+# 受け付け準備ができているか（ゲートウェイ・キャッシュ・DBプール）
+async def is_ready():
+    checks = {
+        "gateway": bot.is_ready() and not bot.is_closed(),
+        "caches": caches_ready.is_set(),
+        "db": await db.health_check(),
+    }
+    return all(checks.values()), checks
+
+def register_metrics():
+    metrics.register_cache("recipe", rakuten.recipe_cache)
+    metrics.register_cache("gemini", gemini.client.cache)
+    metrics.register_cache("prefetch", prefetcher)
+
+    def collect_queues():
+        metrics.cache_size.set(len(food_queue), cache="food_write_queue")
+        metrics.cache_size.set(len(history_queue), cache="history_write_queue")
+        metrics.cache_size.set(len(sessions), cache="sessions")
+        metrics.cache_size.set(len(deletions), cache="pending_deletions")
+
+    metrics.register_collector(collect_queues)
+
+# 終了時：溜まっている書き込みを流してから接続を閉じる
+async def shutdown():
+    global master_listener
+    print("🛑 終了処理開始")
+    await food_queue.close()
+    await history_queue.close()
+    await deletions.close()
+    await rakuten.close_session()
+    if master_listener is not None:
+        # 先に外しておいて、切断をつなぎ直しの対象にしない
+        listener, master_listener = master_listener, None
+        await listener.close()
+    await db.close_pool()
+    print("🛑 終了処理完了")
+
 def run_bot():
-    bot.run(TOKEN)
+    discord.utils.setup_logging()
+    try:
+        asyncio.run(start_bot())
+    except KeyboardInterrupt:
+        pass
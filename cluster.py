@@ -0,0 +1,53 @@
+import os
+import json
+import asyncio
+
+import db
+
+# main.py が複数ワーカーを起動したときに各プロセスへ渡す値
+WORKER_ID = int(os.environ.get("WORKER_ID", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(i) for i in os.environ["SHARD_IDS"].split(",")] if os.environ.get("SHARD_IDS") else None
+
+# ワーカー間でキャッシュの差分を伝えるNOTIFYチャンネル
+EVENTS_CHANNEL = "foodbot_events"
+ENABLED = WORKER_COUNT > 1
+
+_handlers = {}
+
+
+def is_primary():
+    # コマンド同期など、1プロセスだけがやればいい処理用
+    return WORKER_ID == 0
+
+
+def on(kind):
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def publish(kind, **data):
+    # 他のワーカーに知らせる（待たない・失敗してもBotは止めない）
+    if not ENABLED:
+        return
+    payload = json.dumps({"kind": kind, "worker": WORKER_ID, **data}, ensure_ascii=False)
+    task = asyncio.get_running_loop().create_task(db.notify(EVENTS_CHANNEL, payload))
+    task.add_done_callback(_log_failure)
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"ワーカー間通知失敗: {task.exception()}")
+
+
+def handle_event(conn, pid, channel, payload):
+    # LISTENのコールバック。自分が出した通知は無視する
+    event = json.loads(payload)
+    if event.pop("worker") == WORKER_ID:
+        return
+    handler = _handlers.get(event.pop("kind"))
+    if handler is not None:
+        handler(**event)
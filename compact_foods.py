@@ -0,0 +1,49 @@
+# foodsに溜まった表記ゆれ（「麻婆豆腐」「麻婆豆腐です」など）を1つにまとめる一回きりのジョブ
+# 使い方: python compact_foods.py          → まとめる候補を表示するだけ
+#         python compact_foods.py --apply  → consult_history を付け替えて重複を削除する
+import sys
+import asyncio
+
+import db
+import schema
+from dedup import DedupIndex, clean_name
+
+# 残す名前の優先順：手で登録した料理（type 1/2）→ 飾りのない名前 → 短い名前
+def canonical_order(row):
+    name, food_type, genre, style = row
+    return (food_type == "3", name != clean_name(name), len(name), name)
+
+
+def plan_merges(rows):
+    index = DedupIndex()
+    merges = []
+    foods = {(name, food_type, genre, style) for name, food_type, genre, style, *_ in rows}
+    for name, food_type, genre, style in sorted(foods, key=canonical_order):
+        canonical = index.find(name, genre, style)
+        if canonical is None:
+            index.add(name, genre, style)
+        elif canonical != name and food_type == "3":
+            merges.append((name, canonical, genre, style))
+    # 同じ名前が複数行あっても1回だけ
+    return sorted(set(merges), key=lambda m: (m[2], m[3], m[1], m[0]))
+
+
+async def main(apply):
+    await schema.ensure_schema()
+    rows = await db.fetch_all_foods()
+    merges = plan_merges(rows)
+    for duplicate, canonical, genre, style in merges:
+        print(f"{genre}/{style}: 「{duplicate}」→「{canonical}」")
+    print(f"まとめる候補: {len(merges)}件（foods {len(rows)}行中）")
+
+    if apply:
+        exact, rewritten, deleted = await db.merge_foods(merges)
+        print(f"✅ 完全一致の重複削除: {exact}行 / 履歴付け替え: {rewritten}行 / 表記ゆれ削除: {deleted}行")
+        print("Bot側は /reload と /rebuild_history で反映してください")
+    else:
+        print("（--apply をつけると実行します）")
+    await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main("--apply" in sys.argv[1:]))
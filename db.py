@@ -0,0 +1,343 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+import metrics
+
+# 環境変数読み込み
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "5"))
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", "5"))
+DB_HEALTH_TIMEOUT = float(os.environ.get("DB_HEALTH_TIMEOUT", "2"))
+
+# よく使うクエリ（初めて実行したときに asyncpg が接続ごとの statement cache に prepare して持つ）
+RANDOM_FOOD_BY_TYPE = """
+    SELECT name FROM foods
+    WHERE type = $1 OR type = '3'
+    ORDER BY RANDOM()
+    LIMIT 1
+"""
+RANDOM_FOOD_BY_GENRE_STYLE = """
+    SELECT name FROM foods
+    WHERE genre = $1 AND style = $2
+    ORDER BY RANDOM()
+    LIMIT 1
+"""
+SELECT_ALL_FOODS = "SELECT name, type, genre, style, weight FROM foods"
+SELECT_GENRES = "SELECT code, name FROM genres"
+SELECT_STYLES = "SELECT code, name FROM styles"
+# 書き込みキューからまとめて登録する用
+INSERT_FOODS_BATCH = """
+    INSERT INTO foods (name, type, genre, style)
+    SELECT DISTINCT t.name, '3', t.genre, t.style
+    FROM unnest($1::text[], $2::text[], $3::text[]) AS t(name, genre, style)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM foods f
+        WHERE f.name = t.name AND f.genre = t.genre AND f.style = t.style
+    )
+    ON CONFLICT DO NOTHING
+"""
+# request_id は書き込みキューに入れるときに振る。再送しても同じ行は1回しか入らず、集計にも1回だけ足す
+INSERT_HISTORY_BATCH = """
+    WITH inserted AS (
+        INSERT INTO consult_history (request_id, user_id, genre, style, request_text, result_text, result_food)
+        SELECT * FROM unnest($1::uuid[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+        ON CONFLICT (request_id) DO NOTHING
+        RETURNING user_id, genre, style, result_food
+    )
+    INSERT INTO consult_history_rollup (user_id, result_food, genre, style, freq)
+    SELECT user_id, result_food, genre, style, COUNT(*)
+    FROM inserted
+    WHERE result_food IS NOT NULL
+    GROUP BY user_id, result_food, genre, style
+    ON CONFLICT (user_id, result_food, genre, style) DO UPDATE
+    SET freq = consult_history_rollup.freq + EXCLUDED.freq
+"""
+USER_TOP_FOODS = """
+    SELECT result_food, genre, style, COUNT(*) AS freq
+    FROM consult_history
+    WHERE user_id = $1 AND result_food IS NOT NULL
+    GROUP BY result_food, genre, style
+    ORDER BY freq DESC
+    LIMIT 3
+"""
+
+# ユーザーごとの集計テーブル（consult_historyと同じトランザクションで更新する）
+# 集計テーブルが空のときだけ consult_history から作る
+# 複数ワーカーが同時に起動しても1つずつ作るように、同じトランザクションで先にロックを取る
+#（READ COMMITTED なので、ロックを待ったあとの INSERT は先に作った側の結果を見て何もしない）
+HISTORY_SEED_LOCK_ID = 0x466F6F66
+LOCK_HISTORY_SEED = "SELECT pg_advisory_xact_lock($1)"
+SEED_HISTORY_ROLLUP = """
+    INSERT INTO consult_history_rollup (user_id, result_food, genre, style, freq)
+    SELECT user_id, result_food, genre, style, COUNT(*)
+    FROM consult_history
+    WHERE result_food IS NOT NULL AND genre IS NOT NULL AND style IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM consult_history_rollup)
+    GROUP BY user_id, result_food, genre, style
+"""
+REBUILD_HISTORY_ROLLUP = """
+    INSERT INTO consult_history_rollup (user_id, result_food, genre, style, freq)
+    SELECT user_id, result_food, genre, style, COUNT(*)
+    FROM consult_history
+    WHERE result_food IS NOT NULL AND genre IS NOT NULL AND style IS NOT NULL
+    GROUP BY user_id, result_food, genre, style
+"""
+SELECT_HISTORY_ROLLUP = "SELECT user_id, result_food, genre, style, freq FROM consult_history_rollup"
+# 集計テーブルと生データの食い違い件数
+CHECK_HISTORY_ROLLUP = """
+    WITH raw AS (
+        SELECT user_id, result_food, genre, style, COUNT(*)::integer AS freq
+        FROM consult_history
+        WHERE result_food IS NOT NULL AND genre IS NOT NULL AND style IS NOT NULL
+        GROUP BY user_id, result_food, genre, style
+    ), rollup AS (
+        SELECT user_id, result_food, genre, style, freq FROM consult_history_rollup
+    )
+    SELECT COUNT(*) FROM (
+        (SELECT * FROM raw EXCEPT SELECT * FROM rollup)
+        UNION ALL
+        (SELECT * FROM rollup EXCEPT SELECT * FROM raw)
+    ) AS mismatched
+"""
+
+# genres / styles が変わったら master_changed に通知する（トリガーは schema.py のマイグレーションで作る）
+MASTER_CHANNEL = "master_changed"
+
+# Bot自身の設定値（コマンド定義のハッシュなど）
+SELECT_BOT_META = "SELECT value FROM bot_meta WHERE key = $1"
+UPSERT_BOT_META = """
+    INSERT INTO bot_meta (key, value) VALUES ($1, $2)
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+"""
+
+# 表記ゆれの統合（compact_foods.py 用）
+DELETE_EXACT_DUPLICATE_FOODS = """
+    DELETE FROM foods a
+    USING foods b
+    WHERE a.ctid > b.ctid
+      AND a.name = b.name AND a.type = b.type
+      AND a.genre = b.genre AND a.style = b.style
+"""
+REWRITE_HISTORY_FOODS = """
+    UPDATE consult_history h
+    SET result_food = m.canonical
+    FROM unnest($1::text[], $2::text[], $3::text[], $4::text[]) AS m(duplicate, canonical, genre, style)
+    WHERE h.result_food = m.duplicate AND h.genre = m.genre AND h.style = m.style
+"""
+DELETE_MERGED_FOODS = """
+    DELETE FROM foods f
+    USING unnest($1::text[], $2::text[], $3::text[]) AS m(name, genre, style)
+    WHERE f.type = '3' AND f.name = m.name AND f.genre = m.genre AND f.style = m.style
+"""
+
+SELECT_RECIPE_CACHE = """
+    SELECT food_name, recipe_title, recipe_url,
+           EXTRACT(EPOCH FROM now() - fetched_at) AS age
+    FROM recipe_cache
+    WHERE fetched_at > now() - make_interval(secs => $1)
+"""
+UPSERT_RECIPE_CACHE = """
+    INSERT INTO recipe_cache (food_name, recipe_title, recipe_url, fetched_at)
+    VALUES ($1, $2, $3, now())
+    ON CONFLICT (food_name) DO UPDATE
+    SET recipe_title = EXCLUDED.recipe_title,
+        recipe_url = EXCLUDED.recipe_url,
+        fetched_at = EXCLUDED.fetched_at
+"""
+
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool():
+    global _pool
+    if _pool is not None:
+        return _pool
+    async with _pool_lock:
+        if _pool is None:
+            print("🔧 DBプール作成開始")
+            _pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                command_timeout=DB_COMMAND_TIMEOUT,
+            )
+            print("✅ DBプール作成成功")
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+@metrics.track_call("db")
+async def health_check():
+    # SELECT 1 が時間内に返ってくればOK
+    try:
+        pool = await get_pool()
+        async with pool.acquire(timeout=DB_HEALTH_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1", timeout=DB_HEALTH_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"DBヘルスチェック失敗: {e}")
+        return False
+
+
+@asynccontextmanager
+async def connection():
+    # プールを通さない専用の接続（DB_COMMAND_TIMEOUT なし）。DDLや集計の作り直しなど時間のかかる処理用
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def fetch(query, *args):
+    pool = await get_pool()
+    return await pool.fetch(query, *args)
+
+
+async def fetchrow(query, *args):
+    pool = await get_pool()
+    return await pool.fetchrow(query, *args)
+
+
+async def execute(query, *args):
+    pool = await get_pool()
+    return await pool.execute(query, *args)
+
+
+@metrics.track_call("db")
+async def fetch_random_food(food_type):
+    row = await fetchrow(RANDOM_FOOD_BY_TYPE, food_type)
+    return row["name"] if row else None
+
+
+@metrics.track_call("db")
+async def fetch_random_food_by_genre_style(genre, style):
+    row = await fetchrow(RANDOM_FOOD_BY_GENRE_STYLE, genre, style)
+    return row["name"] if row else None
+
+
+@metrics.track_call("db")
+async def fetch_all_foods():
+    rows = await fetch(SELECT_ALL_FOODS)
+    return [(row["name"], row["type"], row["genre"], row["style"], row["weight"]) for row in rows]
+
+
+@metrics.track_call("db")
+async def fetch_master():
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        genres = {row["code"]: row["name"] for row in await conn.fetch(SELECT_GENRES)}
+        styles = {row["code"]: row["name"] for row in await conn.fetch(SELECT_STYLES)}
+    return genres, styles
+
+
+async def get_meta(key):
+    row = await fetchrow(SELECT_BOT_META, key)
+    return row["value"] if row else None
+
+
+async def set_meta(key, value):
+    await execute(UPSERT_BOT_META, key, value)
+
+
+async def listen(channel, callback):
+    # LISTEN用にプールとは別の接続を持つ。callback(conn, pid, channel, payload)
+    conn = await asyncpg.connect(DATABASE_URL)
+    await conn.add_listener(channel, callback)
+    return conn
+
+
+async def notify(channel, payload):
+    await execute("SELECT pg_notify($1, $2)", channel, payload)
+
+
+@metrics.track_call("db")
+async def insert_foods_batch(foods):
+    # foods: (name, genre, style) の並び。既にあるものは飛ばす
+    names, genres, styles = (list(column) for column in zip(*foods))
+    await execute(INSERT_FOODS_BATCH, names, genres, styles)
+
+
+@metrics.track_call("db")
+async def insert_consult_history_batch(rows):
+    # rows: (request_id, user_id, genre, style, request_text, result_text, result_food) の並び
+    # 履歴と集計を1つの文で書くので、途中まで入ることはない
+    columns = [list(column) for column in zip(*rows)]
+    await execute(INSERT_HISTORY_BATCH, *columns)
+
+
+@metrics.track_call("db")
+async def fetch_history_rollup():
+    # 集計テーブルが空なら consult_history から埋める（初回は全件を集計するので専用接続で行う）
+    async with connection() as conn:
+        async with conn.transaction():
+            await conn.execute(LOCK_HISTORY_SEED, HISTORY_SEED_LOCK_ID)
+            await conn.execute(SEED_HISTORY_ROLLUP)
+        rows = await conn.fetch(SELECT_HISTORY_ROLLUP)
+    return [
+        (row["user_id"], row["result_food"], row["genre"], row["style"], row["freq"])
+        for row in rows
+    ]
+
+
+@metrics.track_call("db")
+async def rebuild_history_rollup():
+    # 履歴が多いと DB_COMMAND_TIMEOUT を超えるので、集計の作り直し・確認・統合はプール外の専用接続で行う
+    async with connection() as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE consult_history IN SHARE MODE")
+            await conn.execute("TRUNCATE consult_history_rollup")
+            await conn.execute(REBUILD_HISTORY_ROLLUP)
+
+
+@metrics.track_call("db")
+async def check_history_rollup():
+    async with connection() as conn:
+        return await conn.fetchval(CHECK_HISTORY_ROLLUP)
+
+
+@metrics.track_call("db")
+async def merge_foods(merges):
+    # merges: (重複した名前, 残す名前, genre, style)。履歴を付け替えてから type='3' の重複を消す
+    duplicates, canonicals, genres, styles = (list(column) for column in zip(*merges)) if merges else ([], [], [], [])
+    async with connection() as conn:
+        async with conn.transaction():
+            exact = await conn.execute(DELETE_EXACT_DUPLICATE_FOODS)
+            rewritten = await conn.execute(REWRITE_HISTORY_FOODS, duplicates, canonicals, genres, styles)
+            deleted = await conn.execute(DELETE_MERGED_FOODS, duplicates, genres, styles)
+            await conn.execute("TRUNCATE consult_history_rollup")
+            await conn.execute(REBUILD_HISTORY_ROLLUP)
+    # execute() は "DELETE 3" のようなステータスを返す
+    return tuple(int(status.split()[-1]) for status in (exact, rewritten, deleted))
+
+
+@metrics.track_call("db")
+async def fetch_user_top_foods(user_id):
+    return await fetch(USER_TOP_FOODS, user_id)
+
+
+@metrics.track_call("db")
+async def fetch_recipe_cache(max_age_seconds):
+    rows = await fetch(SELECT_RECIPE_CACHE, float(max_age_seconds))
+    return [
+        (row["food_name"], row["recipe_title"], row["recipe_url"], float(row["age"]))
+        for row in rows
+    ]
+
+
+@metrics.track_call("db")
+async def upsert_recipe_cache(food_name, recipe):
+    title, url = recipe if recipe else (None, None)
+    await execute(UPSERT_RECIPE_CACHE, food_name, title, url)
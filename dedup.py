@@ -0,0 +1,129 @@
+import os
+import re
+import zlib
+import unicodedata
+from array import array
+from functools import lru_cache
+
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.8"))
+MINHASH_BANDS = 16
+MINHASH_ROWS = 2
+_NUM_HASHES = MINHASH_BANDS * MINHASH_ROWS
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+# 固定の係数（プロセスをまたいでも同じハッシュになるように）
+# bigramごとのハッシュ値を覚えておく数（料理名どうしで同じbigramがよく出るので使い回す）
+MINHASH_CACHE_SIZE = int(os.environ.get("MINHASH_CACHE_SIZE", str(1 << 15)))
+_COEFFS = [((i * 0x9E3779B1 + 1) % _PRIME, (i * 0x85EBCA77 + 7) % _PRIME) for i in range(_NUM_HASHES)]
+
+# Geminiがつけがちな飾り：「」や"、語尾の です・だよ・！ など
+_QUOTES = "「」『』【】\"'“”‘’`*"
+# 「がおすすめです！」「はいかがですか？」のように重なるので、語尾は続くかぎり外す
+# かな・とか は料理名の終わり（焼きさかな など）にもなるので、「？」「！」が続くときだけ外す
+_TRAILING = re.compile(
+    r"(?:です[かね]?|でしょうか?|だよ|がおすすめ|はいかが|(?:かな|とか)(?=[!！?？]))*[。．.!！?？~〜…]*$"
+)
+_SPACES = re.compile(r"\s+")
+# ー（長音）は言葉の一部なので外さない（ラーメンとラメンは別物）
+_SYMBOLS = re.compile(r"[\s・･\-－_、,。．.!！?？~〜…]+")
+
+
+def clean_name(text):
+    # 表示・登録用：飾りだけ外して料理名らしくする
+    name = text.strip().splitlines()[0] if text.strip() else ""
+    name = name.strip(_QUOTES + " 　")
+    name = _TRAILING.sub("", name)
+    return _SPACES.sub(" ", name.strip(_QUOTES + " 　"))
+
+
+def normalize(name):
+    # 比較用：全角半角・大文字小文字・記号の違いをならす
+    name = unicodedata.normalize("NFKC", clean_name(name)).lower()
+    return _SYMBOLS.sub("", name)
+
+
+def _grams(normalized):
+    if len(normalized) < 2:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + 2] for i in range(len(normalized) - 1)}
+
+
+@lru_cache(maxsize=MINHASH_CACHE_SIZE)
+def _gram_hashes(gram):
+    h = zlib.crc32(gram.encode())
+    return array("I", [((a * h + b) % _PRIME) & _MASK for a, b in _COEFFS])
+
+
+def _minhash(grams):
+    # ハッシュ関数ごとに、全bigramの中の最小値をとる
+    return list(map(min, zip(*map(_gram_hashes, grams))))
+
+
+def _bands(signature):
+    # MINHASH_ROWS 個ずつ区切ったタプル
+    return zip(*[iter(signature)] * MINHASH_ROWS)
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class DedupIndex:
+    # (ジャンル, スタイル) ごとに料理名を持って、表記ゆれした同じ料理を見つける
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self._exact = {}
+        self._grams = {}
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._exact)
+
+    def rebuild(self, rows):
+        # rows: (name, type, genre, style, ...) の並び
+        self._exact = {}
+        self._grams = {}
+        self._buckets = {}
+        for name, _, genre, style, *_ in rows:
+            self.add(name, genre, style)
+
+    def swap(self, other):
+        # 別スレッドで作った索引と中身を入れ替える（参照している側はそのまま使える）
+        self._exact, self._grams, self._buckets = other._exact, other._grams, other._buckets
+
+    def add(self, name, genre, style):
+        normalized = normalize(name)
+        key = (genre, style, normalized)
+        if not normalized or key in self._exact:
+            return
+        self._exact[key] = name
+        grams = _grams(normalized)
+        self._grams[key] = grams
+        for band, rows in enumerate(_bands(_minhash(grams))):
+            self._buckets.setdefault((genre, style, band, rows), []).append(key)
+
+    def find(self, name, genre, style):
+        # 似ている登録済みの料理名を返す。なければ None
+        normalized = normalize(name)
+        if not normalized:
+            return None
+        existing = self._exact.get((genre, style, normalized))
+        if existing is not None:
+            return existing
+        grams = _grams(normalized)
+        best, best_score = None, self.threshold
+        seen = set()
+        for band, rows in enumerate(_bands(_minhash(grams))):
+            for key in self._buckets.get((genre, style, band, rows), ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                score = jaccard(grams, self._grams[key])
+                if score >= best_score:
+                    best, best_score = self._exact[key], score
+        return best
+
+
+dedup_index = DedupIndex()
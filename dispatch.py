@@ -0,0 +1,198 @@
+import os
+import time
+import heapq
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+import metrics
+from ratelimit import RateLimiter
+
+# Discordのチャンネルごとの枠（だいたい 5回 / 5秒）より少し控えめにして、429で待たされないようにする
+# route → (回数, 秒)。followup はインタラクションのWebhook経由なので、チャンネルではなくインタラクションごとに数える
+ROUTE_BUDGETS = {
+    "send": (int(os.environ.get("DISPATCH_SEND_RATE", "4")), 5.0),
+    "edit": (int(os.environ.get("DISPATCH_EDIT_RATE", "4")), 5.0),
+    "followup": (int(os.environ.get("DISPATCH_FOLLOWUP_RATE", "4")), 5.0),
+    "delete": (int(os.environ.get("DISPATCH_DELETE_RATE", "4")), 5.0),
+}
+# 枠を覚えておくチャンネル・インタラクション数の上限（古いものから忘れる）
+DISPATCH_MAX_CHANNELS = int(os.environ.get("DISPATCH_MAX_CHANNELS", "10000"))
+# 一括削除APIで1回に消せる上限
+BULK_DELETE_LIMIT = 100
+# 終了時に残っている削除予定を流す時間
+DELETE_FLUSH_TIMEOUT = float(os.environ.get("DELETE_FLUSH_TIMEOUT", "5"))
+
+wait_seconds = metrics.Histogram(
+    "foodbot_dispatch_wait_seconds",
+    "Discordへの送信・編集・削除が枠待ちした時間",
+    ("route",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+class Dispatcher:
+    # チャンネルへの送信・編集を route × チャンネル（followup はインタラクション）ごとの枠に通してから投げる
+    def __init__(self, budgets=ROUTE_BUDGETS, max_channels=DISPATCH_MAX_CHANNELS):
+        self.budgets = budgets
+        self.max_channels = max_channels
+        self._limiters = OrderedDict()
+
+    def limiter(self, route, key):
+        key = (route, key)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = RateLimiter(*self.budgets[route])
+            while len(self._limiters) > self.max_channels * len(self.budgets):
+                self._limiters.popitem(last=False)
+        else:
+            self._limiters.move_to_end(key)
+        return limiter
+
+    async def wait(self, route, key):
+        start = time.monotonic()
+        await self.limiter(route, key).acquire()
+        wait_seconds.observe(time.monotonic() - start, route=route)
+
+    async def send(self, channel, content=None, view=None, delete_after=None):
+        await self.wait("send", channel.id)
+        message = await channel.send(content, view=view)
+        if delete_after is not None:
+            deletions.schedule(message, delete_after)
+        return message
+
+    async def followup(self, interaction, content=None, view=None, delete_after=None, ephemeral=False):
+        # defer したインタラクションの続き。消すときのために送ったメッセージを受け取る
+        await self.wait("followup", interaction.id)
+        kwargs = {"view": view} if view is not None else {}
+        message = await interaction.followup.send(content, ephemeral=ephemeral, wait=True, **kwargs)
+        if delete_after is not None:
+            deletions.schedule(message, delete_after)
+        return message
+
+    async def edit_followup(self, interaction, message, content=None):
+        # followup で送ったメッセージの書き換え（ストリーミング表示など）。枠は followup と共有する
+        await self.wait("followup", interaction.id)
+        await message.edit(content=content)
+        return message
+
+    async def edit(self, message, content=None, view=None, delete_after=None):
+        await self.wait("edit", message.channel.id)
+        await message.edit(content=content, view=view)
+        if delete_after is not None:
+            deletions.schedule(message, delete_after)
+        return message
+
+    async def update(self, channel, message, content=None, view=None, delete_after=None):
+        # 同じメッセージを書き換える。まだないか、もう消えていたら新しく送る
+        if message is not None:
+            try:
+                return await self.edit(message, content, view=view, delete_after=delete_after)
+            except discord.NotFound:
+                deletions.cancel(message)
+        return await self.send(channel, content, view=view, delete_after=delete_after)
+
+
+class DeletionScheduler:
+    # delete_after のようにメッセージごとにタスクを作らず、1つのタスクで期限が来たものをまとめて消す
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self._heap = []
+        self._pending = {}
+        self._no_bulk = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, message, delay):
+        # 同じメッセージを入れ直したら期限を上書きする
+        deadline = time.monotonic() + delay
+        self._pending[message.id] = (deadline, message)
+        heapq.heappush(self._heap, (deadline, message.id))
+        if self._heap[0][1] == message.id:
+            self._wakeup.set()
+
+    def cancel(self, message):
+        if message is not None:
+            self._pending.pop(message.id, None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        # 終了時は残りを待たずに消しておく（再起動で消し忘れが残らないように）
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        due = [message for _, message in self._pending.values()]
+        self._pending.clear()
+        self._heap.clear()
+        if due:
+            try:
+                await asyncio.wait_for(self._delete(due), DELETE_FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("メッセージ削除が時間内に終わりませんでした")
+
+    def _pop_due(self):
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, message_id = heapq.heappop(self._heap)
+            entry = self._pending.get(message_id)
+            # 取り消し・入れ直しされた古い予定は飛ばす
+            if entry is None or entry[0] != deadline:
+                continue
+            del self._pending[message_id]
+            due.append(entry[1])
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due()
+            if due:
+                await self._delete(due)
+                continue
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _delete(self, messages):
+        by_channel = {}
+        for message in messages:
+            by_channel.setdefault(message.channel.id, (message.channel, []))[1].append(message)
+        await asyncio.gather(*(
+            self._delete_in_channel(channel, batch) for channel, batch in by_channel.values()
+        ))
+
+    async def _delete_in_channel(self, channel, messages):
+        # 2件以上なら一括削除（メッセージの管理権限がなければ1件ずつ）
+        for i in range(0, len(messages), BULK_DELETE_LIMIT):
+            chunk = messages[i:i + BULK_DELETE_LIMIT]
+            if len(chunk) > 1 and channel.id not in self._no_bulk and hasattr(channel, "delete_messages"):
+                await self.dispatcher.wait("delete", channel.id)
+                try:
+                    await channel.delete_messages(chunk)
+                    continue
+                except discord.Forbidden:
+                    self._no_bulk.add(channel.id)
+                except discord.HTTPException as e:
+                    print(f"メッセージ一括削除失敗: {e}")
+            for message in chunk:
+                await self.dispatcher.wait("delete", channel.id)
+                try:
+                    await message.delete()
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException as e:
+                    print(f"メッセージ削除失敗: {e}")
+
+
+dispatcher = Dispatcher()
+deletions = DeletionScheduler(dispatcher)
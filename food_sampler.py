@@ -0,0 +1,201 @@
+import os
+import random
+from collections import OrderedDict, deque
+
+# type='3' はどちらのガチャにも出てくる料理
+WILDCARD_TYPE = "3"
+# 直近何回ぶんの結果を同じユーザーに出さないか
+RECENT_EXCLUDE_N = int(os.environ.get("RECENT_EXCLUDE_N", "5"))
+RECENT_MAX_USERS = int(os.environ.get("RECENT_MAX_USERS", "100000"))
+# 除外に当たったら引き直す回数の上限（候補が少ないときに回り続けないように）
+MAX_REJECTS = 8
+# あとから足した料理は、この件数たまるまで線形で選び、たまったらエイリアス表のブロックにする
+ALIAS_TAIL_MAX = 32
+
+
+class AliasTable:
+    # Vose のエイリアス法。重みに比例して 0..n-1 の番号をO(1)で選ぶ
+    __slots__ = ("prob", "alias", "total")
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        prob = [0.0] * n
+        alias = [0] * n
+        if n and total > 0:
+            scaled = [w * n / total for w in weights]
+            small = [i for i, p in enumerate(scaled) if p < 1.0]
+            large = [i for i, p in enumerate(scaled) if p >= 1.0]
+            while small and large:
+                s = small.pop()
+                l = large.pop()
+                prob[s] = scaled[s]
+                alias[s] = l
+                scaled[l] = scaled[l] + scaled[s] - 1.0
+                (small if scaled[l] < 1.0 else large).append(l)
+            for i in large + small:
+                prob[i] = 1.0
+        self.prob = prob
+        self.alias = alias
+        self.total = total
+
+    def __len__(self):
+        return len(self.prob)
+
+    def pick(self):
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+class WeightedPool:
+    # 重みつき抽選用。料理をいくつかのブロックに分けて、ブロックごとにエイリアス表を持つ
+    # ブロックの選択もエイリアス表なので、件数によらずO(1)。ALIAS_TAIL_MAX 件未満の追加分だけ線形で選ぶ
+    # build() で作った最初のブロックは作り直さず、追加分のブロックだけ同じ大きさのもの同士でまとめていく
+    #（まとめ直しは追加した件数ぶんだけで、全体を作り直すのは build() のとき＝イベントループの外だけ）
+    __slots__ = ("names", "weights", "total", "_blocks", "_top", "_blocks_total", "_tail")
+
+    def __init__(self):
+        self.names = []
+        self.weights = []
+        self.total = 0.0
+        self._blocks = []  # (先頭の番号, AliasTable)
+        self._top = None
+        self._blocks_total = 0.0
+        self._tail = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, weight=1.0, build=True):
+        # まとめて入れるときは build=False にして、最後に1回 build() する
+        self.names.append(name)
+        self.weights.append(weight)
+        self.total += weight
+        if build and len(self.names) - self._tail >= ALIAS_TAIL_MAX:
+            self._seal()
+
+    def build(self):
+        # 全体を1つのブロックにする
+        self._blocks = [(0, AliasTable(self.weights))] if self.weights else []
+        self._tail = len(self.names)
+        self._update_top()
+
+    def _seal(self):
+        # 線形で選んでいた追加分をブロックにして、同じくらいの大きさの追加ブロックとまとめる
+        start = self._tail
+        self._tail = len(self.names)
+        while len(self._blocks) > 1 and len(self._blocks[-1][1]) <= self._tail - start:
+            start = self._blocks.pop()[0]
+        self._blocks.append((start, AliasTable(self.weights[start:self._tail])))
+        self._update_top()
+
+    def _update_top(self):
+        totals = [table.total for _, table in self._blocks]
+        self._top = AliasTable(totals)
+        self._blocks_total = sum(totals)
+        self.total = self._blocks_total + sum(self.weights[self._tail:])
+
+    def pick(self):
+        if not self.names or self.total <= 0:
+            return None
+        if self._tail < len(self.names) and random.random() * self.total >= self._blocks_total:
+            r = random.random() * (self.total - self._blocks_total)
+            for i in range(self._tail, len(self.names)):
+                r -= self.weights[i]
+                if r < 0:
+                    return self.names[i]
+            return self.names[-1]
+        start, table = self._blocks[self._top.pick()]
+        return self.names[start + table.pick()]
+
+
+class FoodSampler:
+    # foodsテーブルをメモリに持って、ORDER BY RANDOM() の代わりにO(1)で抽選する
+    def __init__(self):
+        self.by_type = {}
+        self.by_genre_style = {}
+        self.loaded = False
+
+    def __len__(self):
+        return sum(len(pool) for pool in self.by_type.values())
+
+    def rebuild(self, rows):
+        # rows: (name, type, genre, style[, weight]) の並び。作り直してから丸ごと差し替える
+        by_type = {}
+        by_genre_style = {}
+        for name, food_type, genre, style, *rest in rows:
+            weight = rest[0] if rest else 1.0
+            by_type.setdefault(food_type, WeightedPool()).add(name, weight, build=False)
+            by_genre_style.setdefault((genre, style), WeightedPool()).add(name, weight, build=False)
+        for pool in list(by_type.values()) + list(by_genre_style.values()):
+            pool.build()
+        self.by_type = by_type
+        self.by_genre_style = by_genre_style
+        self.loaded = True
+
+    def swap(self, other):
+        # 別スレッドで作ったものと中身を入れ替える
+        self.by_type, self.by_genre_style = other.by_type, other.by_genre_style
+        self.loaded = other.loaded
+
+    def add(self, name, food_type, genre, style, weight=1.0):
+        self.by_type.setdefault(food_type, WeightedPool()).add(name, weight)
+        self.by_genre_style.setdefault((genre, style), WeightedPool()).add(name, weight)
+
+    def pick_by_type(self, food_type, exclude=()):
+        # WHERE type = %s OR type = '3' と同じ母集団から重みに比例して選ぶ
+        own = self.by_type.get(food_type) if food_type != WILDCARD_TYPE else None
+        wild = self.by_type.get(WILDCARD_TYPE)
+        own_total = own.total if own else 0.0
+        total = own_total + (wild.total if wild else 0.0)
+        if total <= 0:
+            return None
+
+        def pick():
+            pool = own if random.random() * total < own_total else wild
+            return pool.pick()
+
+        return self._pick_excluding(pick, exclude)
+
+    def pick_by_genre_style(self, genre, style, exclude=()):
+        pool = self.by_genre_style.get((genre, style))
+        if not pool:
+            return None
+        return self._pick_excluding(pool.pick, exclude)
+
+    @staticmethod
+    def _pick_excluding(pick, exclude):
+        # 直近に出した料理なら引き直す。何回やってもダメなら最後の候補で妥協する
+        name = pick()
+        for _ in range(MAX_REJECTS):
+            if name not in exclude:
+                break
+            name = pick()
+        return name
+
+
+class RecentResults:
+    # ユーザーごとの直近の結果（リングバッファ）。ユーザー数も上限つき
+    def __init__(self, size=RECENT_EXCLUDE_N, max_users=RECENT_MAX_USERS):
+        self.size = size
+        self.max_users = max_users
+        self._users = OrderedDict()
+
+    def get(self, user_id):
+        return self._users.get(user_id, ())
+
+    def add(self, user_id, name):
+        if self.size <= 0 or user_id is None or name is None:
+            return
+        recent = self._users.get(user_id)
+        if recent is None:
+            recent = self._users[user_id] = deque(maxlen=self.size)
+        else:
+            self._users.move_to_end(user_id)
+        recent.append(name)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+
+sampler = FoodSampler()
+recent_results = RecentResults()
@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import contextlib
+
+import google.generativeai as genai
+
+import metrics
+import tracing
+from cache import TTLCache
+from ratelimit import RateLimiter
+
+# 環境変数読み込み
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_RATE_PER_MINUTE = int(os.environ.get("GEMINI_RATE_PER_MINUTE", "15"))
+# 先読みなど急がない呼び出しの枠（ライブの枠とは別）と、ライブ用に残しておく枠の数
+GEMINI_BACKGROUND_RATE_PER_MINUTE = int(os.environ.get("GEMINI_BACKGROUND_RATE_PER_MINUTE", "3"))
+GEMINI_BACKGROUND_RESERVE = int(os.environ.get("GEMINI_BACKGROUND_RESERVE", "5"))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", "5"))
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "20"))
+GEMINI_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", "1024"))
+GEMINI_CACHE_TTL = float(os.environ.get("GEMINI_CACHE_TTL", str(7 * 24 * 3600)))
+
+genai.configure(api_key=GEMINI_API_KEY)
+
+
+class GeminiBusyError(Exception):
+    # レート・同時実行の枠が空かなかったとき
+    pass
+
+
+class GeminiClient:
+    # Botで1つだけ使うGeminiクライアント。model に偽物を渡せばローカルで動かせる
+    def __init__(self, model=None):
+        self._model = model
+        self._semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+        self._limiter = RateLimiter(GEMINI_RATE_PER_MINUTE)
+        self._background_limiter = RateLimiter(GEMINI_BACKGROUND_RATE_PER_MINUTE)
+        # 料理説明・レシピなど毎回同じ答えでいいプロンプト用
+        self.cache = TTLCache(maxsize=GEMINI_CACHE_SIZE, ttl=GEMINI_CACHE_TTL, negative_ttl=0)
+        # 保存はせず、同じプロンプトの同時リクエストをまとめるだけ
+        self._inflight = TTLCache(maxsize=0)
+        # 生成中のストリーム（プロンプト → SharedStream）
+        self._streams = {}
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = genai.GenerativeModel(GEMINI_MODEL)
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    async def _acquire(self):
+        await self._semaphore.acquire()
+        try:
+            await self._limiter.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def _wait_slot(self):
+        # 枠待ちが長引くなら諦めて呼び出し元のフォールバックに任せる
+        try:
+            with tracing.child_span("gemini:wait_slot"):
+                await asyncio.wait_for(self._acquire(), GEMINI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise GeminiBusyError("Geminiの呼び出し枠が空いていません")
+
+    async def _call(self, prompt):
+        await self._wait_slot()
+        return await self._generate(prompt)
+
+    async def _generate(self, prompt):
+        # 枠を取ったあとの呼び出し。終わったら同時実行の枠を返す
+        try:
+            with tracing.child_span("gemini:generate"), \
+                    metrics.timer(metrics.external_seconds, metrics.external_errors, service="gemini", operation="generate"):
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(prompt), GEMINI_TIMEOUT
+                )
+            return response.text.strip()
+        finally:
+            self._semaphore.release()
+
+    async def generate(self, prompt):
+        return await self._inflight.get_or_fetch(prompt, lambda: self._call(prompt))
+
+    async def generate_background(self, prompt):
+        # 先読み用。自分の枠があって、ライブ用の枠が GEMINI_BACKGROUND_RESERVE 個より多く残っているときだけ呼ぶ
+        # 空いていなければ待たずに None を返す（ライブの呼び出しを待たせない）
+        if self._semaphore.locked() or not self._background_limiter.try_acquire():
+            return None
+        if not self._limiter.try_acquire(reserve=GEMINI_BACKGROUND_RESERVE):
+            return None
+        await self._semaphore.acquire()
+        return await self._generate(prompt)
+
+    async def stream_cached(self, prompt):
+        # 生成途中の全文を届いた分だけ yield する。キャッシュにあれば全文を1回だけ返す
+        # 同じプロンプトを同時に頼まれたら、モデルは1回だけ呼んで同じストリームを見せる
+        # 見ている人が全員やめたら（aclose・キャンセル）ストリームを閉じて枠を返す
+        cached = self.cache.get(prompt)
+        if cached is not None:
+            self.cache.hits += 1
+            yield cached
+            return
+        self.cache.misses += 1
+
+        shared = self._streams.get(prompt)
+        if shared is None:
+            shared = self._streams[prompt] = SharedStream()
+            shared.task = asyncio.get_running_loop().create_task(self._produce(prompt, shared))
+        shared.subscribers += 1
+        try:
+            sent = ""
+            while True:
+                updated = shared.updated
+                if shared.text != sent:
+                    sent = shared.text
+                    yield sent
+                elif shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                else:
+                    await updated.wait()
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.done:
+                if self._streams.get(prompt) is shared:
+                    del self._streams[prompt]
+                shared.task.cancel()
+                # 閉じ終わってから戻る（枠が返ったことを呼び出し元が当てにできるように）
+                await asyncio.wait([shared.task])
+
+    async def _produce(self, prompt, shared):
+        # stream_cached の裏で1本だけ動くストリーム。届いた分を shared に書いていく
+        try:
+            await self._wait_slot()
+        except GeminiBusyError as e:
+            self._streams.pop(prompt, None)
+            shared.finish(e)
+            return
+        start = time.perf_counter()
+        deadline = time.monotonic() + GEMINI_TIMEOUT
+        chunks = None
+        try:
+            with tracing.child_span("gemini:stream_start"):
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(prompt, stream=True), GEMINI_TIMEOUT
+                )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    shared.push(shared.text + chunk.text)
+            if shared.text.strip():
+                self.cache.set(prompt, shared.text.strip())
+            shared.finish()
+        except Exception as e:
+            metrics.external_errors.inc(service="gemini", operation="stream")
+            shared.finish(e)
+        finally:
+            if self._streams.get(prompt) is shared:
+                del self._streams[prompt]
+            self._semaphore.release()
+            metrics.external_seconds.observe(time.perf_counter() - start, service="gemini", operation="stream")
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                # 閉じるのに失敗しても、返事はもう済んでいるので無視する
+                with contextlib.suppress(Exception):
+                    await aclose()
+
+
+class SharedStream:
+    # 同じプロンプトの同時ストリームが見る共有の状態。text は届いた分までの全文
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.updated = asyncio.Event()
+
+    def _notify(self):
+        # 待っている人を全員起こして、次の更新用に Event を作り直す
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    def push(self, text):
+        self.text = text
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+
+client = GeminiClient()
@@ -0,0 +1,71 @@
+import os
+
+HISTORY_TOP_N = int(os.environ.get("HISTORY_TOP_N", "3"))
+
+
+class UserRollup:
+    # ユーザー1人分の (料理, ジャンル, スタイル) → 回数 と上位N件
+    __slots__ = ("counts", "top")
+
+    def __init__(self):
+        self.counts = {}
+        self.top = []
+
+    def add(self, key, n, top_n):
+        count = self.counts.get(key, 0) + n
+        self.counts[key] = count
+        # 回数は増えるだけなので、上位に入るのは最下位を超えたときだけ
+        if key in self.top:
+            self.top.sort(key=self.counts.__getitem__, reverse=True)
+        elif len(self.top) < top_n or count > self.counts[self.top[-1]]:
+            self.top.append(key)
+            self.top.sort(key=self.counts.__getitem__, reverse=True)
+            del self.top[top_n:]
+
+
+class HistoryRollup:
+    # consult_history を GROUP BY しなくていいように、ユーザーごとの集計をメモリに持つ
+    def __init__(self, top_n=HISTORY_TOP_N):
+        self.top_n = top_n
+        self.users = {}
+        self.loaded = False
+
+    def rebuild(self, rows):
+        # rows: (user_id, 料理, ジャンル, スタイル, 回数) の並び
+        users = {}
+        for user_id, food, genre, style, freq in rows:
+            rollup = users.get(user_id)
+            if rollup is None:
+                rollup = users[user_id] = UserRollup()
+            rollup.add((food, genre, style), freq, self.top_n)
+        self.users = users
+        self.loaded = True
+
+    def add(self, user_id, food, genre, style):
+        if food is None:
+            return
+        rollup = self.users.get(user_id)
+        if rollup is None:
+            rollup = self.users[user_id] = UserRollup()
+        rollup.add((food, genre, style), 1, self.top_n)
+
+    def top(self, user_id):
+        # [(料理, ジャンル, スタイル, 回数), ...] を回数の多い順で返す
+        rollup = self.users.get(user_id)
+        if rollup is None:
+            return []
+        return [(*key, rollup.counts[key]) for key in rollup.top]
+
+    def diff(self, rows):
+        # DBの集計と比べて、食い違っている (user_id, 料理, ジャンル, スタイル) を返す
+        expected = {}
+        for user_id, food, genre, style, freq in rows:
+            expected[(user_id, food, genre, style)] = freq
+        actual = {}
+        for user_id, rollup in self.users.items():
+            for (food, genre, style), count in rollup.counts.items():
+                actual[(user_id, food, genre, style)] = count
+        return [key for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key)]
+
+
+history_rollup = HistoryRollup()
@@ -1,15 +1,43 @@
-from flask import Flask
-from threading import Thread
+import os
 
-app = Flask('')
+from aiohttp import web
 
-@app.route('/')
-def home():
-    return "I'm alive!"
+import metrics
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+KEEP_ALIVE_HOST = os.environ.get("KEEP_ALIVE_HOST", "0.0.0.0")
+KEEP_ALIVE_PORT = int(os.environ.get("KEEP_ALIVE_PORT", "8080"))
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+
+def make_app(is_live, is_ready):
+    # is_live(): 同期で bool、is_ready(): 非同期で (bool, 詳細dict)
+    async def home(request):
+        return web.Response(text="I'm alive!")
+
+    async def healthz(request):
+        if is_live():
+            return web.Response(text="ok")
+        return web.Response(text="not live", status=503)
+
+    async def readyz(request):
+        ready, checks = await is_ready()
+        return web.json_response(checks, status=200 if ready else 503)
+
+    async def metrics_handler(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/metrics", metrics_handler)
+    return app
+
+
+async def keep_alive(is_live, is_ready):
+    # Botと同じイベントループでHTTPサーバーを立てる。止めるときは runner.cleanup()
+    runner = web.AppRunner(make_app(is_live, is_ready), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, KEEP_ALIVE_HOST, KEEP_ALIVE_PORT)
+    await site.start()
+    print(f"keep_alive起動: {KEEP_ALIVE_HOST}:{KEEP_ALIVE_PORT}")
+    return runner
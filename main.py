@@ -1,7 +1,84 @@
-from keep_alive import keep_alive
-from bot import run_bot  
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+# BOT_WORKERS=N で N プロセスに分けて起動する（シャードは SHARD_COUNT 個を順番に割り振る）
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+SHARD_COUNT = max(BOT_WORKERS, int(os.environ.get("SHARD_COUNT", str(BOT_WORKERS))))
+KEEP_ALIVE_PORT = int(os.environ.get("KEEP_ALIVE_PORT", "8080"))
+GEMINI_RATE_PER_MINUTE = int(os.environ.get("GEMINI_RATE_PER_MINUTE", "15"))
+GEMINI_BACKGROUND_RATE_PER_MINUTE = int(os.environ.get("GEMINI_BACKGROUND_RATE_PER_MINUTE", "3"))
+GEMINI_BACKGROUND_RESERVE = int(os.environ.get("GEMINI_BACKGROUND_RESERVE", "5"))
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", "5"))
+
+
+def run_worker(worker_id):
+    # bot を import する前に、このワーカーの担当を環境変数で渡す
+    shard_ids = [shard for shard in range(SHARD_COUNT) if shard % BOT_WORKERS == worker_id]
+    os.environ["WORKER_ID"] = str(worker_id)
+    os.environ["WORKER_COUNT"] = str(BOT_WORKERS)
+    os.environ["SHARD_COUNT"] = str(SHARD_COUNT)
+    os.environ["SHARD_IDS"] = ",".join(map(str, shard_ids))
+    # ヘルスチェックのポートはワーカーごとにずらす
+    os.environ["KEEP_ALIVE_PORT"] = str(KEEP_ALIVE_PORT + worker_id)
+    # Geminiの呼び出し枠は全ワーカーで分け合う
+    os.environ["GEMINI_RATE_PER_MINUTE"] = str(max(1, GEMINI_RATE_PER_MINUTE // BOT_WORKERS))
+    os.environ["GEMINI_BACKGROUND_RATE_PER_MINUTE"] = str(max(1, GEMINI_BACKGROUND_RATE_PER_MINUTE // BOT_WORKERS))
+    os.environ["GEMINI_BACKGROUND_RESERVE"] = str(GEMINI_BACKGROUND_RESERVE // BOT_WORKERS)
+
+    from bot import run_bot
+    print(f"ワーカー{worker_id}起動: シャード {shard_ids}/{SHARD_COUNT}")
+    run_bot()
+
+
+def start_worker(worker_id):
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_worker, args=(worker_id,), name=f"foodbot-worker-{worker_id}"
+    )
+    process.start()
+    return process
+
+
+def run_workers():
+    workers = {worker_id: start_worker(worker_id) for worker_id in range(BOT_WORKERS)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # 落ちたワーカーは少し待ってから起動し直す
+    while not stopping:
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive() and not stopping:
+                print(f"ワーカー{worker_id}が終了しました（exit {process.exitcode}）。再起動します")
+                time.sleep(WORKER_RESTART_DELAY)
+                # 待っている間に止めるよう言われていたら、もう起動しない
+                if stopping:
+                    break
+                workers[worker_id] = start_worker(worker_id)
+        time.sleep(1)
+
+    # stop() のあとに起動したワーカーがいても、止めてから待つ
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
 
 if __name__ == "__main__":
-    keep_alive()
-    print("keep_alive呼び出し")
-    run_bot()
\ No newline at end of file
+    if BOT_WORKERS <= 1:
+        # keep_alive（ヘルスチェック・メトリクス）はBotのイベントループ上で起動する
+        from bot import run_bot
+        run_bot()
+    else:
+        run_workers()
+        sys.exit(0)
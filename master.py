@@ -0,0 +1,37 @@
+class MasterSnapshot:
+    # ジャンル・スタイルのマスタと、そこから作る表示用データ。作ったあとは変更しない
+    __slots__ = ("version", "genres", "styles", "genres_text", "styles_text", "genre_buttons", "style_buttons")
+
+    def __init__(self, version, genres, styles):
+        self.version = version
+        self.genres = genres
+        self.styles = styles
+        # /genres /styles の本文
+        self.genres_text = "📚 登録ジャンル一覧：\n" + "\n".join([f"{code} = {name}" for code, name in genres.items()])
+        self.styles_text = "🎨 登録スタイル一覧：\n" + "\n".join([f"{code} = {name}" for code, name in styles.items()])
+        # GenreView / StyleView に並べるボタンの (ラベル, コード)
+        self.genre_buttons = tuple((name, code) for code, name in genres.items())
+        self.style_buttons = tuple((name, code) for code, name in styles.items())
+
+    def genre_name(self, code):
+        return self.genres.get(code, code)
+
+    def style_name(self, code):
+        return self.styles.get(code, code)
+
+
+class MasterData:
+    # snapshot は丸ごと差し替えるだけなので、読む側はロックなしで一貫した内容が見える
+    def __init__(self):
+        self.snapshot = MasterSnapshot(0, {}, {})
+
+    def update(self, genres, styles):
+        # 内容が変わったときだけバージョンを上げる
+        current = self.snapshot
+        if current.version and genres == current.genres and styles == current.styles:
+            return False
+        self.snapshot = MasterSnapshot(current.version + 1, dict(genres), dict(styles))
+        return True
+
+
+master_data = MasterData()
@@ -0,0 +1,207 @@
+import time
+import asyncio
+import functools
+from contextlib import contextmanager
+
+import tracing
+
+# Prometheusのテキスト形式で出すだけの最小限のメトリクス
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 3, 5, 10)
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            # [各バケットの件数..., 合計, 件数]
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        self._values[tuple(labels[name] for name in self.labelnames)] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+interaction_seconds = Histogram(
+    "foodbot_interaction_seconds",
+    "スラッシュコマンド・ボタンの処理時間",
+    ("kind", "name"),
+)
+interaction_errors = Counter(
+    "foodbot_interaction_errors_total",
+    "スラッシュコマンド・ボタンで例外が出た回数",
+    ("kind", "name"),
+)
+external_seconds = Histogram(
+    "foodbot_external_call_seconds",
+    "DB・Gemini・楽天APIの呼び出し時間",
+    ("service", "operation"),
+)
+external_errors = Counter(
+    "foodbot_external_call_errors_total",
+    "DB・Gemini・楽天APIの呼び出し失敗回数",
+    ("service", "operation"),
+)
+cache_hit_rate = Gauge("foodbot_cache_hit_rate", "キャッシュのヒット率", ("cache",))
+cache_size = Gauge("foodbot_cache_entries", "キャッシュの件数", ("cache",))
+event_loop_lag = Gauge("foodbot_event_loop_lag_seconds", "イベントループの遅れ（直近）")
+event_loop_lag_seconds = Histogram(
+    "foodbot_event_loop_lag_seconds_hist",
+    "イベントループの遅れの分布",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+def register_collector(collector):
+    # /metrics を出す直前に呼ばれる（キャッシュのヒット率などをその場で集める）
+    _collectors.append(collector)
+
+
+def register_cache(name, cache):
+    def collect():
+        stats = cache.stats()
+        cache_hit_rate.set(stats["hit_rate"], cache=name)
+        cache_size.set(stats["size"], cache=name)
+
+    register_collector(collect)
+
+
+def render():
+    for collector in _collectors:
+        collector()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def timer(histogram, errors=None, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def track_command(name):
+    # スラッシュコマンドの処理時間を測ってトレースを取る（@bot.tree.command の内側に付ける）
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction, *args, **kwargs):
+            with tracing.span(f"command:{name}", user=interaction.user.id, channel=interaction.channel_id), \
+                    timer(interaction_seconds, interaction_errors, kind="command", name=name):
+                return await func(interaction, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def track_button(name=None):
+    # ボタンの callback の処理時間を測ってトレースを取る。name がなければ custom_id で分ける
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, interaction, *args, **kwargs):
+            label = name or self.custom_id
+            with tracing.span(f"button:{label}", user=interaction.user.id, channel=interaction.channel_id), \
+                    timer(interaction_seconds, interaction_errors, kind="button", name=label):
+                return await func(self, interaction, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def track_call(service):
+    # DB・外部APIの呼び出し時間を関数名ごとに測る（トレースはコマンド・ボタンの中のときだけ）
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracing.child_span(f"{service}:{func.__name__}"), \
+                    timer(external_seconds, external_errors, service=service, operation=func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def monitor_event_loop(interval=0.5):
+    # sleepが予定よりどれだけ遅れて戻ってきたかをループの遅れとして記録する
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        event_loop_lag.set(lag)
+        event_loop_lag_seconds.observe(lag)
@@ -0,0 +1,96 @@
+import os
+import re
+import asyncio
+from collections import Counter, deque
+
+PREFETCH_BATCH_SIZE = int(os.environ.get("PREFETCH_BATCH_SIZE", "5"))
+PREFETCH_LOW_WATER = int(os.environ.get("PREFETCH_LOW_WATER", "2"))
+PREFETCH_MAX_POOL = int(os.environ.get("PREFETCH_MAX_POOL", "20"))
+PREFETCH_TOP_COMBOS = int(os.environ.get("PREFETCH_TOP_COMBOS", "5"))
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", "300"))
+
+# 「1. 麻婆豆腐」「・麻婆豆腐」などの頭についた番号・記号
+_BULLET = re.compile(r"^\s*(?:[-*・●]|\d+[.)．、]?)\s*")
+
+
+def parse_dish_list(text):
+    names = []
+    for line in text.splitlines():
+        name = _BULLET.sub("", line).strip().strip("「」\"'")
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class SuggestionPrefetcher:
+    # (ジャンル, スタイル) ごとにGeminiの提案を先に何個か作っておく
+    # generate(prompt) -> str または None（見送り）、make_prompt(genre, style, n) -> str、on_generated(genre, style, names)
+    def __init__(self, generate, make_prompt, on_generated, batch_size=PREFETCH_BATCH_SIZE):
+        self.generate = generate
+        self.make_prompt = make_prompt
+        self.on_generated = on_generated
+        self.batch_size = batch_size
+        self.pools = {}
+        self.popularity = Counter()
+        self.hits = 0
+        self.misses = 0
+        self._refilling = {}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": sum(len(pool) for pool in self.pools.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def pool_size(self, genre, style):
+        return len(self.pools.get((genre, style), ()))
+
+    def note_selected(self, genre, style):
+        # スタイルが押された時点で、要望の入力を待つあいだに補充を始める
+        self.popularity[(genre, style)] += 1
+        self.ensure_refill(genre, style)
+
+    def take(self, genre, style):
+        pool = self.pools.get((genre, style))
+        if pool:
+            self.hits += 1
+            name = pool.popleft()
+            self.ensure_refill(genre, style)
+            return name
+        self.misses += 1
+        return None
+
+    def ensure_refill(self, genre, style):
+        key = (genre, style)
+        if self.pool_size(genre, style) >= PREFETCH_LOW_WATER or key in self._refilling:
+            return
+        task = asyncio.get_running_loop().create_task(self._refill(genre, style))
+        self._refilling[key] = task
+        task.add_done_callback(lambda _: self._refilling.pop(key, None))
+
+    async def _refill(self, genre, style):
+        # 1回の呼び出しで batch_size 個まとめて作る
+        try:
+            text = await self.generate(self.make_prompt(genre, style, self.batch_size))
+        except Exception as e:
+            print(f"[先読み失敗] {genre}/{style}: {e}")
+            return
+        if not text:
+            # Geminiの枠が空いていないので今回は見送り（次に選ばれたときにまた試す）
+            return
+        names = parse_dish_list(text)
+        if not names:
+            return
+        pool = self.pools.setdefault((genre, style), deque(maxlen=PREFETCH_MAX_POOL))
+        pool.extend(name for name in names if name not in pool)
+        self.on_generated(genre, style, names)
+
+    async def refill_popular(self, interval=PREFETCH_INTERVAL, top=PREFETCH_TOP_COMBOS):
+        # よく選ばれる組み合わせは、誰も押していなくても定期的に補充しておく
+        while True:
+            for (genre, style), _ in self.popularity.most_common(top):
+                self.ensure_refill(genre, style)
+            await asyncio.sleep(interval)
@@ -0,0 +1,100 @@
+import os
+import asyncio
+
+import aiohttp
+
+import metrics
+from cache import TTLCache
+
+# 環境変数読み込み（RAKUTEN_API_URL はスタブサーバーに向けるときに使う）
+RAKUTEN_APP_ID = os.environ.get("RAKUTEN_APP_ID")
+RAKUTEN_API_URL = os.environ.get(
+    "RAKUTEN_API_URL",
+    "https://app.rakuten.co.jp/services/api/Recipe/RecipeKeywordSearch/20170426",
+)
+RAKUTEN_TIMEOUT = float(os.environ.get("RAKUTEN_TIMEOUT", "3"))
+RAKUTEN_MAX_CONNECTIONS = int(os.environ.get("RAKUTEN_MAX_CONNECTIONS", "10"))
+RAKUTEN_MAX_CONCURRENCY = int(os.environ.get("RAKUTEN_MAX_CONCURRENCY", "5"))
+RECIPE_CACHE_SIZE = int(os.environ.get("RECIPE_CACHE_SIZE", "2048"))
+RECIPE_CACHE_TTL = float(os.environ.get("RECIPE_CACHE_TTL", str(24 * 3600)))
+RECIPE_CACHE_NEGATIVE_TTL = float(os.environ.get("RECIPE_CACHE_NEGATIVE_TTL", "1800"))
+# 1にするとrecipe_cacheテーブルにも保存して、再起動後もキャッシュを引き継ぐ
+RECIPE_CACHE_PERSIST = os.environ.get("RECIPE_CACHE_PERSIST") == "1"
+
+# 料理名 → (タイトル, URL) または None（該当なし）
+recipe_cache = TTLCache(
+    maxsize=RECIPE_CACHE_SIZE,
+    ttl=RECIPE_CACHE_TTL,
+    negative_ttl=RECIPE_CACHE_NEGATIVE_TTL,
+)
+
+_session = None
+_semaphore = None
+# 保存中の on_fetched（終了時に待つため、途中で捨てられないように持っておく）
+_saving = set()
+
+
+def get_session():
+    # keep-aliveの接続を使い回すため、セッションは1つだけ作る
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=RAKUTEN_MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=RAKUTEN_TIMEOUT),
+        )
+        _semaphore = asyncio.Semaphore(RAKUTEN_MAX_CONCURRENCY)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _saving:
+        await asyncio.gather(*_saving, return_exceptions=True)
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+@metrics.track_call("rakuten")
+async def search_recipe(food_name):
+    # 見つかったら (タイトル, URL)、なければ None
+    session = get_session()
+    params = {
+        "format": "json",
+        "applicationId": RAKUTEN_APP_ID,
+        "keyword": food_name,
+    }
+    # aiohttp は None のクエリパラメータを受け付けない
+    params = {key: value for key, value in params.items() if value is not None}
+    async with _semaphore:
+        async with session.get(RAKUTEN_API_URL, params=params) as response:
+            # 429・5xx などは例外にして、「レシピなし」としてキャッシュ・保存されないようにする
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+    if data.get("result"):
+        recipe = data["result"][0]
+        return recipe["recipeTitle"], recipe["recipeUrl"]
+    return None
+
+
+async def get_recipe(food_name, on_fetched=None):
+    # キャッシュ経由で検索。実際に取りに行ったときだけ on_fetched(料理名, 結果) を呼ぶ
+    # on_fetched（DBへの保存など）は待たずに裏で動かして、返事を遅らせない
+    async def fetch():
+        recipe = await search_recipe(food_name)
+        if on_fetched is not None:
+            task = asyncio.get_running_loop().create_task(on_fetched(food_name, recipe))
+            _saving.add(task)
+            task.add_done_callback(_saving.discard)
+        return recipe
+
+    return await recipe_cache.get_or_fetch(food_name, fetch)
+
+
+def warm_cache(rows):
+    # rows: (料理名, タイトル, URL, 経過秒数)。DBに残っている結果をキャッシュに戻す
+    for food_name, title, url, age in rows:
+        recipe = (title, url) if title else None
+        ttl = (RECIPE_CACHE_TTL if recipe else RECIPE_CACHE_NEGATIVE_TTL) - age
+        if ttl > 0:
+            recipe_cache.set(food_name, recipe, ttl=ttl)
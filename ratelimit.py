@@ -0,0 +1,34 @@
+import time
+import asyncio
+
+
+class RateLimiter:
+    # トークンバケット。rate 回 / per 秒まで、バーストは rate 回まで許す
+    def __init__(self, rate, per=60.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+    def try_acquire(self, reserve=0):
+        # 待たずに取れるときだけ取る。reserve 個ぶんは他の呼び出しのために残しておく
+        self._refill()
+        if self._tokens >= 1 + reserve:
+            self._tokens -= 1
+            return True
+        return False
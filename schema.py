@@ -0,0 +1,226 @@
+# テーブル定義とインデックスの管理。起動時に migrate() → ensure_indexes() の順で呼ぶ
+# 使い方: python schema.py  → マイグレーションを当てて、インデックスの状態を表示する
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+import db
+
+# 複数ワーカーが同時に起動しても、マイグレーション・インデックス作成はそれぞれ1プロセスずつ
+# インデックス作成は時間がかかるので、マイグレーションとは別のロックにする
+MIGRATION_LOCK_ID = 0x466F6F64
+INDEX_LOCK_ID = 0x466F6F65
+# ロックが取れなかったときに取り直すまでの間隔
+SCHEMA_LOCK_POLL_INTERVAL = float(os.environ.get("SCHEMA_LOCK_POLL_INTERVAL", "0.5"))
+
+CREATE_SCHEMA_MIGRATIONS = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+SELECT_APPLIED = "SELECT version FROM schema_migrations"
+INSERT_APPLIED = "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)"
+
+# (バージョン, 名前, SQL)。既存のDBに当てても壊れないように IF NOT EXISTS で書く
+MIGRATIONS = (
+    (1, "base_tables", """
+        CREATE TABLE IF NOT EXISTS genres (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS styles (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS foods (
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            genre TEXT,
+            style TEXT
+        );
+        CREATE TABLE IF NOT EXISTS consult_history (
+            id BIGSERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            genre TEXT,
+            style TEXT,
+            request_text TEXT,
+            result_text TEXT,
+            result_food TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    # ガチャの出やすさ（既存の行はすべて1）
+    (2, "foods_weight", """
+        ALTER TABLE foods ADD COLUMN IF NOT EXISTS weight REAL NOT NULL DEFAULT 1;
+    """),
+    (3, "bot_tables", """
+        CREATE TABLE IF NOT EXISTS recipe_cache (
+            food_name TEXT PRIMARY KEY,
+            recipe_title TEXT,
+            recipe_url TEXT,
+            fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS consult_history_rollup (
+            user_id TEXT NOT NULL,
+            result_food TEXT NOT NULL,
+            genre TEXT NOT NULL,
+            style TEXT NOT NULL,
+            freq INTEGER NOT NULL,
+            PRIMARY KEY (user_id, result_food, genre, style)
+        );
+    """),
+    # 書き込みキューの再送で履歴が重複しないように、行ごとのIDをつける（既存の行は NULL のまま）
+    (4, "consult_history_request_id", """
+        ALTER TABLE consult_history ADD COLUMN IF NOT EXISTS request_id UUID;
+        CREATE UNIQUE INDEX IF NOT EXISTS consult_history_request_id_idx ON consult_history (request_id);
+    """),
+    # genres / styles が変わったら db.MASTER_CHANNEL に通知する
+    #（CREATE OR REPLACE TRIGGER は PostgreSQL 14 からなので、DROP してから作る）
+    (5, "master_notify", """
+        CREATE OR REPLACE FUNCTION notify_master_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('master_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS genres_master_changed ON genres;
+        CREATE TRIGGER genres_master_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON genres
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_master_changed();
+        DROP TRIGGER IF EXISTS styles_master_changed ON styles;
+        CREATE TRIGGER styles_master_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON styles
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_master_changed();
+    """),
+)
+
+# インデックス名 → 定義。db.py のクエリの WHERE / GROUP BY に合わせてある
+# foods.type は値が3種類しかなく、type = $1 OR type = '3' は表の大半に当たるのでインデックスは張らない
+#（ふだんはメモリの FoodSampler が引くので、このクエリはDBフォールバックのときだけ）
+INDEXES = {
+    # RANDOM_FOOD_BY_GENRE_STYLE と、INSERT_FOODS_BATCH / DELETE_MERGED_FOODS の (name, genre, style) 照合
+    "foods_genre_style_name_idx": "ON foods (genre, style, name)",
+    # USER_TOP_FOODS：user_id で絞って result_food, genre, style で GROUP BY（NULLの行は対象外）
+    "consult_history_user_food_idx": (
+        "ON consult_history (user_id, result_food, genre, style) WHERE result_food IS NOT NULL"
+    ),
+    # REWRITE_HISTORY_FOODS（compact_foods.py）の result_food 照合
+    "consult_history_result_food_idx": (
+        "ON consult_history (result_food, genre, style) WHERE result_food IS NOT NULL"
+    ),
+    # SELECT_RECIPE_CACHE の fetched_at > now() - ...
+    "recipe_cache_fetched_at_idx": "ON recipe_cache (fetched_at)",
+}
+# indisvalid = false は CREATE INDEX CONCURRENTLY が途中で失敗した残骸
+SELECT_INDEXES = """
+    SELECT c.relname AS name, i.indisvalid AS valid
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = ANY($1::text[])
+      AND pg_table_is_visible(c.oid)
+"""
+
+
+@asynccontextmanager
+async def advisory_lock(conn, lock_id):
+    # pg_advisory_lock で待つと、待っている間もスナップショットを持ったままになり
+    # 別の接続の CREATE INDEX CONCURRENTLY がそれを待ってデッドロックする。なので取れるまで取り直す
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", lock_id):
+        await asyncio.sleep(SCHEMA_LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", lock_id)
+
+
+async def migrate(conn):
+    # 当たっていないマイグレーションを順番に当てる。当てたバージョンのリストを返す
+    async with advisory_lock(conn, MIGRATION_LOCK_ID):
+        await conn.execute(CREATE_SCHEMA_MIGRATIONS)
+        applied = {row["version"] for row in await conn.fetch(SELECT_APPLIED)}
+        done = []
+        for version, name, sql in MIGRATIONS:
+            if version in applied:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(INSERT_APPLIED, version, name)
+            print(f"✅ マイグレーション {version}: {name}")
+            done.append(version)
+        return done
+
+
+async def index_status(conn):
+    # {インデックス名: 'ok' / 'missing' / 'invalid'}
+    rows = await conn.fetch(SELECT_INDEXES, list(INDEXES))
+    found = {row["name"]: row["valid"] for row in rows}
+    return {
+        name: "missing" if name not in found else "ok" if found[name] else "invalid"
+        for name in INDEXES
+    }
+
+
+async def ensure_indexes(conn):
+    # ないものは書き込みを止めないように CONCURRENTLY で作る（トランザクションの外で実行する）
+    async with advisory_lock(conn, INDEX_LOCK_ID):
+        for name, state in (await index_status(conn)).items():
+            if state == "ok":
+                continue
+            if state == "invalid":
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            print(f"🔧 インデックス作成: {name}")
+            await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {INDEXES[name]}")
+        return await index_status(conn)
+
+
+# テーブルがまだない状態でも、インデックス作成に何分かかっても動くように、
+# プールではなく専用の接続（コマンドタイムアウトなし）を使う
+async def migrate_schema():
+    async with db.connection() as conn:
+        return await migrate(conn)
+
+
+async def build_indexes():
+    # 足りないインデックスを作って、作れなかったものを報告する
+    async with db.connection() as conn:
+        status = await ensure_indexes(conn)
+    return report_indexes(status)
+
+
+async def check_indexes():
+    # 作るのは別のプロセスに任せて、状態だけ報告する
+    async with db.connection() as conn:
+        status = await index_status(conn)
+    return report_indexes(status)
+
+
+def report_indexes(status):
+    problems = {name: state for name, state in status.items() if state != "ok"}
+    if problems:
+        print(f"❌ インデックスが揃っていません: {problems}")
+    else:
+        print(f"✅ スキーマ確認OK（インデックス {len(status)}件）")
+    return problems
+
+
+async def ensure_schema():
+    # マイグレーションとインデックス作成をまとめて行う（CLI・compact_foods.py 用）
+    await migrate_schema()
+    return await build_indexes()
+
+
+async def main():
+    await ensure_schema()
+    async with db.connection() as conn:
+        for name, state in (await index_status(conn)).items():
+            print(f"{state:8} {name} {INDEXES[name]}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+import os
+import time
+
+# Viewのtimeout（60秒）に合わせて、操作が止まったセッションは自動で消す
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "60"))
+
+
+class Session:
+    # コンサル1回分の状態（ユーザー×チャンネルごと）
+    __slots__ = ("channel_id", "user_id", "mode", "genre", "style", "request", "has_request", "message", "expires_at")
+
+    def __init__(self, channel_id, user_id, mode):
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.mode = mode
+        self.genre = None
+        self.style = None
+        self.request = None
+        self.has_request = False
+        # コンサルの途中経過を書き換えていくメッセージ
+        self.message = None
+        self.expires_at = 0.0
+
+    def waiting_for_request(self):
+        return self.genre is not None and self.style is not None and not self.has_request
+
+
+class SessionStore:
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = {}
+        self._next_sweep = time.monotonic() + ttl
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, channel_id, user_id):
+        key = (channel_id, user_id)
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        if session.expires_at <= time.monotonic():
+            del self._sessions[key]
+            return None
+        return session
+
+    def start(self, channel_id, user_id, mode):
+        self._maybe_sweep()
+        session = Session(channel_id, user_id, mode)
+        self._sessions[(channel_id, user_id)] = session
+        self.touch(session)
+        return session
+
+    def get_or_start(self, channel_id, user_id, mode):
+        session = self.get(channel_id, user_id)
+        if session is None:
+            session = self.start(channel_id, user_id, mode)
+        return session
+
+    def touch(self, session):
+        # ボタンを押すたびに期限を延ばす（次のViewのtimeoutぶん）
+        session.expires_at = time.monotonic() + self.ttl
+
+    def end(self, session):
+        key = (session.channel_id, session.user_id)
+        if self._sessions.get(key) is session:
+            del self._sessions[key]
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = [key for key, session in self._sessions.items() if session.expires_at <= now]
+        for key in expired:
+            del self._sessions[key]
+        return len(expired)
+
+    def _maybe_sweep(self):
+        # 放置されたセッションをTTLごとにまとめて掃除する
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep()
+            self._next_sweep = now + self.ttl
+
+
+sessions = SessionStore()
@@ -0,0 +1,46 @@
+import json
+import time
+import hashlib
+from contextlib import asynccontextmanager
+
+
+class StartupTimer:
+    # 起動の各段階にかかった時間を記録する
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.ready_at = None
+
+    @asynccontextmanager
+    async def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - start
+            print(f"⏱ {name}: {self.phases[name] * 1000:.0f}ms")
+
+    def mark(self, name):
+        # 起動開始からの経過時間として記録する（ゲートウェイ接続など）
+        self.phases[name] = time.monotonic() - self.started
+        print(f"⏱ {name}: {self.phases[name] * 1000:.0f}ms（起動から）")
+
+    def mark_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+            self.mark("time_to_ready")
+
+    def summary(self):
+        return dict(self.phases)
+
+
+def command_tree_hash(tree):
+    # スラッシュコマンド定義のハッシュ。変わったときだけ tree.sync() すればいい
+    payload = []
+    for command in tree.get_commands():
+        try:
+            payload.append(command.to_dict(tree))
+        except TypeError:
+            payload.append(command.to_dict())
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import logging
+import threading
+import itertools
+import traceback
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# 遅い・失敗したもの以外は、この割合だけ出す（本番でつけっぱなしにできるように少なめ）
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "2500"))
+BLOCKING_THRESHOLD = float(os.environ.get("BLOCKING_THRESHOLD", "0.1"))
+
+logger = logging.getLogger("foodbot.trace")
+
+_current = contextvars.ContextVar("foodbot_span", default=None)
+_trace_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ("name", "attrs", "parent", "trace_id", "start", "duration", "error", "children")
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else next(_trace_ids)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def to_dict(self, depth=0):
+        # 子spanは平らに並べる（深さだけ残す）
+        row = {"name": self.name, "depth": depth, "ms": round(self.duration * 1000, 2)}
+        if self.error:
+            row["error"] = self.error
+        rows = [row]
+        for child in self.children:
+            if child.duration is not None:
+                rows.extend(child.to_dict(depth + 1))
+        return rows
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    # コマンド・ボタンならトレースの根、その中のDB・HTTP・LLM呼び出しなら子になる
+    parent = _current.get()
+    s = Span(name, attrs, parent)
+    token = _current.set(s)
+    try:
+        yield s
+    except Exception as e:
+        s.error = repr(e)
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        _current.reset(token)
+        if parent is None:
+            _emit(s)
+        else:
+            parent.children.append(s)
+
+
+def child_span(name, **attrs):
+    # DB・HTTP・LLM呼び出し用：コマンド・ボタンの中でだけ子spanを作る
+    # ヘルスチェックや書き込みキューなど、外から呼ばれたものはトレースの根にしない
+    if _current.get() is None:
+        return nullcontext()
+    return span(name, **attrs)
+
+
+def _emit(root):
+    # 遅い・失敗したトレースは必ず、それ以外はサンプリングして1行JSONで出す
+    slow = root.duration * 1000 >= TRACE_SLOW_MS
+    if not (slow or root.error or random.random() < TRACE_SAMPLE_RATE):
+        return
+    record = {
+        "event": "trace",
+        "trace_id": root.trace_id,
+        "name": root.name,
+        "ms": round(root.duration * 1000, 2),
+        "slow": slow,
+        "attrs": root.attrs,
+        "spans": root.to_dict()[1:],
+    }
+    if root.error:
+        record["error"] = root.error
+    level = logging.WARNING if slow or root.error else logging.INFO
+    logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+
+class BlockingDetector:
+    # 別スレッドからイベントループの心拍を見て、止まっていたらスタックを記録する
+    def __init__(self, threshold=BLOCKING_THRESHOLD):
+        self.threshold = threshold
+        self.interval = threshold / 2
+        self.blocked_count = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread = None
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        # イベントループのスレッドから呼ぶ
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="blocking-detector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        blocked_since = None
+        while not self._stop.wait(self.interval):
+            behind = time.monotonic() - self._last_beat - self.interval
+            if behind > self.threshold and blocked_since is None:
+                blocked_since = self._last_beat
+                self.blocked_count += 1
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                logger.warning(json.dumps({
+                    "event": "loop_blocked",
+                    "blocked_ms": round(behind * 1000, 2),
+                    "stack": [line.strip() for line in stack[-15:]],
+                }, ensure_ascii=False))
+            elif behind <= self.threshold and blocked_since is not None:
+                logger.warning(json.dumps({
+                    "event": "loop_unblocked",
+                    "blocked_ms": round((time.monotonic() - blocked_since) * 1000, 2),
+                }))
+                blocked_since = None
+
+
+blocking_detector = BlockingDetector()
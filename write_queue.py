@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "100"))
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", "1"))
+WRITE_RETRY_DELAY = float(os.environ.get("WRITE_RETRY_DELAY", "1"))
+WRITE_MAX_RETRY_DELAY = float(os.environ.get("WRITE_MAX_RETRY_DELAY", "60"))
+WRITE_CLOSE_RETRIES = int(os.environ.get("WRITE_CLOSE_RETRIES", "3"))
+# バッチでこの回数失敗したら1件ずつ書いて、書けない行を切り分ける
+WRITE_SPLIT_AFTER = int(os.environ.get("WRITE_SPLIT_AFTER", "3"))
+# 何度やっても通らないデータのエラー（SQLSTATE 22: データ例外, 23: 制約違反）
+_BAD_ROW_SQLSTATES = ("22", "23")
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    # 書き込みを溜めて、バックグラウンドでまとめて flush(records) する
+    def __init__(self, name, flush, batch_size=WRITE_BATCH_SIZE, interval=WRITE_FLUSH_INTERVAL):
+        self.name = name
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.failures = 0
+        self.dropped = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._closing = False
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, record):
+        # 呼び出し側は待たない
+        self._queue.put_nowait(record)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def sync(self):
+        # ここまでに put した分を書き終わるまで待つ（あとから put された分は待たない）
+        if self._task is None or self._task.done():
+            return
+        written = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(written)
+        await written
+
+    async def close(self):
+        # 溜まっている分を書き切ってから止める
+        if self._task is None or self._task.done():
+            return
+        self._closing = True
+        self._queue.put_nowait(_STOP)
+        await self._task
+
+    async def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = await self._next_batch()
+            # sync() の目印は書き込まずに、バッチを書き終わってから知らせる
+            waiters = [record for record in batch if isinstance(record, asyncio.Future)]
+            batch = [record for record in batch if not isinstance(record, asyncio.Future)]
+            if batch:
+                await self._flush_with_retry(batch)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _next_batch(self):
+        first = await self._queue.get()
+        if first is _STOP:
+            return self._drain_nowait(), True
+        batch = [first]
+        if isinstance(first, asyncio.Future):
+            return batch, False
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if record is _STOP:
+                return batch + self._drain_nowait(), True
+            batch.append(record)
+            if isinstance(record, asyncio.Future):
+                # sync() を待たせないように、ここまでで区切る
+                break
+        return batch, False
+
+    def _drain_nowait(self):
+        records = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not _STOP:
+                records.append(record)
+        return records
+
+    async def _flush_with_retry(self, batch):
+        # 失敗してもバッチは捨てずに、間隔を延ばしながらやり直す
+        delay = WRITE_RETRY_DELAY
+        attempts = 0
+        while True:
+            try:
+                await self.flush(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                self.failures += 1
+                attempts += 1
+                print(f"❌ {self.name}の書き込み失敗（{len(batch)}件, {attempts}回目）: {e}")
+                if attempts >= WRITE_SPLIT_AFTER:
+                    batch = await self._flush_rows(batch)
+                    if not batch:
+                        return
+                if self._closing and attempts >= WRITE_CLOSE_RETRIES:
+                    print(f"❌ {self.name}: 終了時に{len(batch)}件を書き込めませんでした: {batch}")
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WRITE_MAX_RETRY_DELAY)
+
+    async def _flush_rows(self, batch):
+        # 1行のせいで全部が止まらないように1件ずつ書く。データが原因の行は捨てて、残りを返す
+        remaining = []
+        for record in batch:
+            try:
+                await self.flush([record])
+                self.written += 1
+            except Exception as e:
+                if str(getattr(e, "sqlstate", "") or "")[:2] in _BAD_ROW_SQLSTATES:
+                    self.dropped += 1
+                    print(f"❌ {self.name}: 書き込めない行を捨てました（{e}）: {record!r}")
+                else:
+                    remaining.append(record)
+        return remaining